@@ -1,5 +1,6 @@
 import atexit
 import os
+import pathlib
 import sys
 
 from apscheduler.schedulers.background import BackgroundScheduler
@@ -10,28 +11,139 @@ from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import create_engine, event
 from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from app.executor import BoundedExecutor
+from app.liveness import PeerRegistry
+from app.wire import WireFormats, WireRequest
+from app.writer import DatabaseWriter
 
 app = Flask(__name__)
+# Request bodies from peers may be compressed or MessagePack
+app.request_class = WireRequest
 
 # Configurations
 if getattr(sys, 'frozen', False):
     BASE_DIR = os.path.dirname(sys.executable)
 elif __file__:
     BASE_DIR = os.path.dirname(__file__)
-app.config["SQLALCHEMY_DATABASE_URI"] = 'sqlite:///' + os.path.join(BASE_DIR, 'app.db')
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URI", 'sqlite:///' + os.path.join(BASE_DIR, 'app.db'))
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "poolclass": QueuePool,
+    "pool_size": 10,  # Connections kept open to the database
+    "max_overflow": 10,  # Extra connections opened under load
+    "connect_args": {"check_same_thread": False},  # Pooled connections are used by more than one thread
+}
+app.config["SQLITE_JOURNAL_MODE"] = "WAL"  # Readers do not wait for writers and writers do not wait for readers
+app.config["SQLITE_SYNCHRONOUS"] = "NORMAL"  # In WAL mode only checkpoints wait for the disk
+app.config["SQLITE_CACHE_SIZE"] = -64000  # Page cache per connection, negative is in KiB
+app.config["SQLITE_MMAP_SIZE"] = 256 * 1024 * 1024  # Bytes of the database file read through memory mapping
+app.config["SQLITE_BUSY_TIMEOUT"] = 5000  # Milliseconds to wait for another connection's write lock
+app.config["WRITER_MAX_BATCH"] = 64  # Maximum writes committed in one transaction
+app.config["WRITER_LATENCY_BUDGET"] = 0.005  # Seconds a write waits for others to be committed together with
+app.config["WRITER_RESULT_TIMEOUT"] = 30  # Seconds to wait for a write to be committed before giving up on it
+app.config["RESPONSE_CACHE_SIZE"] = 1024  # Responses of /caseinfo and /filenameAndHash kept in memory
+app.config["USER_CASE_CACHE_SIZE"] = 1024  # Users whose assigned cases are kept in memory
+app.config["SEARCH_ENABLED"] = True  # Keep a full-text index of the blocks, if SQLite is built with FTS5
+app.config["SEARCH_MAX_RESULTS"] = 100  # Maximum blocks returned by /search
+app.config["SEARCH_BACKFILL_BATCH"] = 1000  # Blocks indexed in one transaction by flask index-blocks
 app.config["THREADS_PER_PAGE"] = 2
+app.config["CONNECT_TIMEOUT"] = 3  # Seconds to wait for a peer to accept the connection
+app.config["READ_TIMEOUT"] = 3  # Seconds to wait for a peer to respond
+app.config["HTTP_POOL_PEERS"] = 32  # Number of peers to keep connections open to
+app.config["HTTP_POOL_CONNECTIONS_PER_PEER"] = 5  # Maximum open connections to a single peer
+app.config["WIRE_FORMATS"] = ["msgpack", "zstd", "gzip"]  # Formats offered to peers, if installed, JSON is always known
+app.config["WIRE_COMPRESS_MIN_SIZE"] = 1024  # Bytes from which data sent to peers is compressed
+app.config["EXECUTOR_WORKERS"] = 5  # Worker threads for outbound requests
+app.config["EXECUTOR_QUEUE_SIZE"] = 100  # Outbound requests that can wait for a worker
+app.config["EXECUTOR_SUBMIT_TIMEOUT"] = 10  # Seconds to wait for room in a full queue
+app.config["PEER_STALE_AFTER"] = 30  # Seconds a peer is trusted to be alive after it was last heard from
+app.config["PEER_FAILURE_THRESHOLD"] = 2  # Consecutive failures before a peer is considered dead
+app.config["PEER_BACKOFF"] = 10  # Seconds before a dead peer is probed again, doubled on every failure
+app.config["PEER_MAX_BACKOFF"] = 300  # Maximum seconds before a dead peer is probed again
+app.config["SYNC_PEER_CONCURRENCY"] = 2  # Requests for missing blocks sent to a single node at a time
+app.config["SYNC_PAGE_SIZE"] = 500  # Blocks asked for in one request and added in one transaction when syncing
+app.config["SYNC_MAX_PAGE_SIZE"] = 1000  # Maximum blocks sent in one page of /sync
+app.config["POOL_BATCH_SIZE"] = 100  # Maximum unverified blocks sent to a delegate in one request
+app.config["SEGMENT_CONSENSUS"] = False  # Vote on the consecutive unverified blocks of a case as one segment
+app.config["SEGMENT_MAX_SIZE"] = 100  # Maximum unverified blocks in one segment
 # app.config.from_object('config')
 
 auth = HTTPTokenAuth(scheme='Bearer')
+executor = BoundedExecutor(app.config["EXECUTOR_WORKERS"], app.config["EXECUTOR_QUEUE_SIZE"],
+                           app.config["EXECUTOR_SUBMIT_TIMEOUT"])
+peer_registry = PeerRegistry(app.config["PEER_STALE_AFTER"], app.config["PEER_FAILURE_THRESHOLD"],
+                             app.config["PEER_BACKOFF"], app.config["PEER_MAX_BACKOFF"])
+wire_formats = WireFormats(app.config["WIRE_FORMATS"], app.config["WIRE_COMPRESS_MIN_SIZE"])
 db = SQLAlchemy(app)
 
-# Using SQLAlchemy ORM for Session
-engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"])
+
+def set_sqlite_pragmas(dbapi_connection, read_only):
+    """
+    Apply the SQLite settings of the config to a new connection
+
+    :param dbapi_connection: New connection to the database
+    :type dbapi_connection: sqlite3.Connection
+    :param read_only: Whether the connection is opened read only, which cannot change the journal mode
+    :type read_only: bool
+    """
+    cursor = dbapi_connection.cursor()
+    if not read_only:
+        cursor.execute("PRAGMA journal_mode = {}".format(app.config["SQLITE_JOURNAL_MODE"]))
+        cursor.execute("PRAGMA synchronous = {}".format(app.config["SQLITE_SYNCHRONOUS"]))
+    cursor.execute("PRAGMA cache_size = {}".format(int(app.config["SQLITE_CACHE_SIZE"])))
+    cursor.execute("PRAGMA mmap_size = {}".format(int(app.config["SQLITE_MMAP_SIZE"])))
+    cursor.execute("PRAGMA busy_timeout = {}".format(int(app.config["SQLITE_BUSY_TIMEOUT"])))
+    cursor.close()
+
+
+# Using SQLAlchemy ORM for Session, sharing the engine and connections of Flask-SQLAlchemy
+engine = db.engine
 session_factory = sessionmaker(bind=engine)
 Session = scoped_session(session_factory)
 
-from app.controller import sync_schedule, send_unverified_block, check_twothird
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine, "connect")
+    def set_write_pragmas(dbapi_connection, connection_record):
+        set_sqlite_pragmas(dbapi_connection, False)
+
+# Read only connections for the query endpoints, so they never wait for a connection used for writing
+if engine.dialect.name == "sqlite" and engine.url.database not in (None, "", ":memory:"):
+    read_only_uri = pathlib.Path(os.path.abspath(engine.url.database)).as_uri()
+    read_engine = create_engine("sqlite:///{}?mode=ro&uri=true".format(read_only_uri),
+                                **app.config["SQLALCHEMY_ENGINE_OPTIONS"])
+
+    @event.listens_for(read_engine, "connect")
+    def set_read_pragmas(dbapi_connection, connection_record):
+        set_sqlite_pragmas(dbapi_connection, True)
+else:
+    read_engine = engine
+ReadSession = scoped_session(sessionmaker(bind=read_engine))
+
+# Every change to the database goes through the writer thread
+writer = DatabaseWriter(engine, app.config["WRITER_MAX_BATCH"], app.config["WRITER_LATENCY_BUDGET"],
+                        app.config["WRITER_RESULT_TIMEOUT"])
+
+
+@app.teardown_appcontext
+def remove_read_session(exception=None):
+    """
+    Return the read only connection of the request to the pool
+    """
+    ReadSession.remove()
+
+
+# Full-text index of the blocks, created once the database is built
+from app.search import SearchIndex
+search_index = SearchIndex(app.config["SEARCH_ENABLED"])
+
+# Digest of the case heads compared with peers before syncing, filled once the database is built
+from app.digest import StateDigest
+state_digest = StateDigest()
+
+from app.controller import sync_schedule, send_unverified_block, check_twothird, warm_up_checkpoints, \
+    rebuild_pool_deadlines, load_state_digest, http_session
 
 bg_scheduler = BackgroundScheduler()
 trigger = interval.IntervalTrigger(seconds=10)
@@ -40,8 +152,9 @@ bg_scheduler.add_job(func=send_unverified_block, trigger=trigger)
 bg_scheduler.add_job(func=check_twothird, trigger=trigger)
 bg_scheduler.start()
 
-from app import views
+from app import views, commands
 from app.models import Peers
+from app.migrations import upgrade, check_query_plans
 
 
 # Init the Peers Table db with values (hardcode)
@@ -68,6 +181,25 @@ def insert_initial_values(*args, **kwargs):
 
 # Build the database
 db.create_all()
+upgrade(db.engine)
+for (detail, statement) in check_query_plans(db.engine):
+    app.logger.warning("Query falls back to a table scan (%s):\n%s", detail, statement)
+search_index.create(db.engine)
+load_state_digest()
+
+# Verify all cases once and queue the unverified blocks in the background
+bg_scheduler.add_job(func=warm_up_checkpoints)
+bg_scheduler.add_job(func=rebuild_pool_deadlines)
+
+
+# Shut down the scheduler, outbound workers, connections to peers and the writer when exiting the app
+def shutdown():
+    bg_scheduler.shutdown()
+    executor.shutdown()
+    http_session.close()
+    writer.shutdown()
+    read_engine.dispose()
+    engine.dispose()
+
 
-# Shut down the scheduler when exiting the app
-atexit.register(lambda: bg_scheduler.shutdown())
+atexit.register(shutdown)
@@ -0,0 +1,82 @@
+"""
+cache.py
+========
+In-memory cache of the responses of the query endpoints
+"""
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    Keeps the latest response of every endpoint and case or user, together with the version it was built from
+
+    The version of a case is the hash of its last block, an entry is only returned while the case still ends with that
+    block. Entries of a case or user are also dropped as soon as a change to it is committed. The least recently used
+    entries are dropped once the cache is full.
+    """
+
+    def __init__(self, max_entries):
+        """
+        Init function of ResponseCache Class
+
+        :param max_entries: Maximum number of responses kept
+        :type max_entries: int
+        """
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        # Counts the invalidations, so a response built from data read before one is not cached after it
+        self.generation = 0
+
+    def get(self, key, etag):
+        """
+        Return the cached response if it was built from the given last block
+
+        :param key: Endpoint and case ID or username
+        :type key: tuple
+        :param etag: Current version, e.g. the hash of the last block of the case
+        :type etag: str
+        :return: Body of the response, None if not cached
+        :rtype: dict
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != etag:
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, etag, body, generation=None):
+        """
+        Cache a response, unless the cache has been invalidated since the given generation
+
+        :param key: Endpoint and case ID or username
+        :type key: tuple
+        :param etag: Version the response was built from, e.g. the hash of the last block of the case
+        :type etag: str
+        :param body: Body of the response
+        :type body: dict
+        :param generation: generation of the cache before the response was built
+        :type generation: int
+        """
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[key] = (etag, body)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, id_list):
+        """
+        Drop the responses of cases or users that have changed
+
+        :param id_list: ID of the cases or usernames
+        :type id_list: iterable
+        """
+        id_list = set(id_list)
+        with self.lock:
+            self.generation += 1
+            for key in [key for key in self.entries if key[1] in id_list]:
+                del self.entries[key]
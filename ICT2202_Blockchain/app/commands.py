@@ -0,0 +1,36 @@
+"""
+commands.py
+===========
+Maintenance commands run with the flask command, e.g. flask index-blocks
+"""
+import click
+
+from app import app, db, search_index, read_engine, writer
+from app.migrations import check_query_plans
+
+
+@app.cli.command("index-blocks")
+@click.option("--batch-size", default=app.config["SEARCH_BACKFILL_BATCH"], show_default=True,
+              help="Blocks indexed in one transaction")
+def index_blocks(batch_size):
+    """
+    Add the blocks that are missing from the full-text search index
+    """
+    if not search_index.enabled:
+        click.echo("Full-text search is disabled or SQLite is built without FTS5")
+        return
+    indexed = search_index.backfill(read_engine, writer, batch_size)
+    click.echo("Indexed {} blocks".format(indexed))
+
+
+@app.cli.command("check-query-plans")
+def check_plans():
+    """
+    Fail if any of the hot queries falls back to scanning a whole table
+    """
+    scans = check_query_plans(db.engine)
+    for (detail, statement) in scans:
+        click.echo("Query falls back to a table scan ({}):\n{}\n".format(detail, statement))
+    if scans:
+        raise click.ClickException("{} queries scan a whole table".format(len(scans)))
+    click.echo("Every hot query uses an index")
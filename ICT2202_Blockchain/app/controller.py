@@ -7,18 +7,47 @@ import hashlib
 import json
 import math
 import random
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+from concurrent.futures import FIRST_COMPLETED, as_completed, wait
 from datetime import datetime, timedelta
 
 import requests
 from dateutil import parser
-
-from app import db, Session
-from app.models import Block, Peers, Pool, Consensus, UserCase
+from requests.adapters import HTTPAdapter
+from sqlalchemy import String, and_, cast, func, or_, select
+from sqlalchemy.dialects.sqlite import insert
+from werkzeug.http import quote_etag
+
+from app import app, db, Session, executor, peer_registry, wire_formats, writer, read_engine, state_digest
+from app.digest import BUCKETS, differing_buckets
+from app.executor import ExecutorFull
+from app.liveness import ALIVE, UNKNOWN
+from app.deadlines import DeadlineQueue
+from app.merkle import proof_keys, proof_subtrees, subtree_hash
+from app.models import Block, Peers, Pool, Consensus, UserCase, Checkpoint, CaseHead, MerkleNode, on_block_commit
+from app.tally import VoteTally
+from app.wire import decode_response
 
 SYNC_INTERVAL = 60 * 10  # 10 Mins
 TIMEOUT = 30
 
+vote_tally = VoteTally()
+pool_deadlines = DeadlineQueue()
+# Held while sync_schedule runs, so runs never overlap
+sync_lock = threading.Lock()
+# Hash of the last block of every case when it was last verified, the case is not verified again until it changes
+verified_heads = {}
+# Held while the state digest reads case heads, so an older read never overwrites a newer one
+digest_lock = threading.Lock()
+# Cases whose new head could not be read after their commit, read again on the next sync
+stale_digest_cases = set()
+
+
+class ChainVerificationFailed(Exception):
+    """
+    Raised by a writer job to discard blocks that do not verify against the rest of their case
+    """
+
 
 def convert_to_block(json_block):
     """
@@ -44,17 +73,22 @@ def convert_to_block(json_block):
         return None
 
 
-def convert_to_pool(json_block):
+def convert_to_pool(json_block, block_number=None, previous_block_hash=None):
     """
     Return given data into pool format
 
     :param json_block: the data given by user, must contain case_id, meta_data and log
     :type json_block: json
+    :param block_number: length of the case, looked up if not given
+    :type block_number: int
+    :param previous_block_hash: block hash of the last block of the case, looked up if not given
+    :type previous_block_hash: str
     :return: Pool object
     :rtype: None if failed
     """
     try:
-        block = Pool(json_block["case_id"], json.dumps(json_block["meta_data"]), json.dumps(json_block["log"]))
+        block = Pool(json_block["case_id"], json.dumps(json_block["meta_data"]), json.dumps(json_block["log"]),
+                     block_number=block_number, previous_block_hash=previous_block_hash)
         if "block_number" in json_block and "previous_block_hash" in json_block and "timestamp" in json_block and "block_hash" in json_block:
             block.case_id = json_block["case_id"]
             block.block_number = json_block["block_number"]
@@ -90,6 +124,154 @@ def convert_to_consensus(json_block, ip_address):
         return None
 
 
+# Shared session so connections to peers are kept alive and reused, bounded per peer
+http_session = requests.Session()
+http_session.mount("http://", HTTPAdapter(pool_connections=app.config["HTTP_POOL_PEERS"],
+                                          pool_maxsize=app.config["HTTP_POOL_CONNECTIONS_PER_PEER"],
+                                          pool_block=True))
+
+
+def get_timeout():
+    """
+    Return the timeout used for requests to other peers
+
+    :return: Connect and read timeout in seconds
+    :rtype: tuple
+    """
+    return app.config["CONNECT_TIMEOUT"], app.config["READ_TIMEOUT"]
+
+
+def add_received_blocks(session, json_pool):
+    """
+    Writer job that adds the entries uploaded to /receiveblock, block 0 of a new case to the blockchain and the rest to
+    the pool
+
+    :param session: Session of the writer
+    :type session: Session
+    :param json_pool: Entries uploaded, each must contain case_id, meta_data and log
+    :type json_pool: list
+    :return: Result of every entry, blocks added and unverified blocks added
+    :rtype: tuple
+    """
+    # Look up the last block of every case in the batch at once
+    case_list = list({json_block.get("case_id") for json_block in json_pool if isinstance(json_block, dict)})
+    case_heads = {case_head.case_id: (case_head.length, case_head.last_hash)
+                  for case_head in session.query(CaseHead).filter(CaseHead.case_id.in_(case_list)).all()}
+
+    results = []
+    new_block_list = []
+    new_pool_list = []
+    for json_block in json_pool:
+
+        # Convert into class object
+        block = None
+        if isinstance(json_block, dict) and "case_id" in json_block:
+            (length, last_hash) = case_heads.get(json_block["case_id"], (0, ""))
+            block = convert_to_pool(json_block, block_number=length, previous_block_hash=last_hash)
+        if block is None:
+            results.append({"Status": "Error"})
+            continue
+
+        # If case doesnt exist (Block 0) add to block directly
+        if block.block_number == 0:
+            # Add to Block
+            new_block = Block(block.case_id, block.meta_data, block.log, block_number=block.block_number,
+                              previous_block_hash=block.previous_block_hash, timestamp=block.timestamp,
+                              block_hash=block.block_hash, status=1)
+            session.add(new_block)
+            new_block_list.append(new_block)
+            case_heads[block.case_id] = (1, block.block_hash)
+            results.append({"case_id": block.case_id, "block_number": 0, "block_hash": block.block_hash,
+                            "Status": "Block"})
+        else:
+            # Add to Pool, it is sent out once it is the oldest block of its case
+            session.add(block)
+            new_pool_list.append(block)
+            results.append({"case_id": block.case_id, "block_number": block.block_number,
+                            "block_hash": block.block_hash, "Status": "Pool"})
+    return results, new_block_list, new_pool_list
+
+
+def record_votes(vote_list, ip_address, timeout):
+    """
+    Add or update the votes of a delegate in a single transaction, adding the blocks that reach the threshold
+
+    Votes for blocks that are no longer in the pool, have not been sent out or have timed out are discarded
+
+    :param vote_list: Votes given by the delegate, each must contain pool_id and response
+    :type vote_list: list
+    :param ip_address: ip address of the delegate
+    :type ip_address: str
+    :param timeout: How long after the block is sent out votes are accepted
+    :type timeout: timedelta
+    :return: Number of votes recorded
+    :rtype: int
+    """
+    responses = {}
+    for vote_json in vote_list:
+        consensus = convert_to_consensus(vote_json, ip_address)
+        if consensus is None or consensus.response not in (True, False):
+            continue
+        try:
+            responses[int(consensus.pool_id)] = consensus.response
+        except (TypeError, ValueError):
+            continue
+    if len(responses) == 0:
+        return 0
+
+    rows = writer.call(store_votes, responses, ip_address, timeout)
+    if len(rows) == 0:
+        return 0
+
+    # Add blocks as soon as they reach the threshold instead of waiting for check_twothird
+    twothird = get_vote_threshold(db.session)
+    passed_list = []
+    for row in rows:
+        pool_id = int(row["pool_id"])
+        if vote_tally.add(pool_id, ip_address, row["response"]) >= twothird:
+            passed_list.append(pool_id)
+    if len(passed_list) > 0:
+        add_passed_blocks(passed_list)
+
+    return len(rows)
+
+
+def store_votes(session, responses, ip_address, timeout):
+    """
+    Writer job that adds or updates the votes of a delegate on the blocks still open for voting
+
+    :param session: Session of the writer
+    :type session: Session
+    :param responses: Vote of the delegate by ID of the unverified block
+    :type responses: dict
+    :param ip_address: ip address of the delegate
+    :type ip_address: str
+    :param timeout: How long after the block is sent out votes are accepted
+    :type timeout: timedelta
+    :return: Votes stored
+    :rtype: list
+    """
+    now = datetime.now()
+    rows = []
+    for pool in session.query(Pool).filter(Pool.id.in_(list(responses))).all():
+        if pool.sendout_time is None or pool.sendout_time + timeout < now:
+            continue
+        rows.append({"ip_address": ip_address, "pool_id": str(pool.id), "response": responses[pool.id],
+                     "receive_timestamp": now})
+    if len(rows) == 0:
+        return rows
+
+    # One vote per delegate per block, a new vote replaces the old one
+    table = Consensus.__table__
+    statement = insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.pool_id, table.c.ip_address],
+        set_={"response": statement.excluded.response, "receive_timestamp": statement.excluded.receive_timestamp}
+    )
+    session.execute(statement, rows)
+    return rows
+
+
 def check_health(peer):
     """Return response of target
 
@@ -103,13 +285,19 @@ def check_health(peer):
     :rtype: Peers
     """
     try:
-        resp = requests.get("http://{}:{}/health".format(peer.ip_address, peer.port), timeout=3)
-        if resp.status_code == 200:
-            return peer
-
-        return None
+        resp = http_session.get("http://{}:{}/health".format(peer.ip_address, peer.port),
+                                headers=wire_formats.header(), timeout=get_timeout())
     except:
+        peer_registry.record_failure(peer.ip_address)
         return None
+    wire_formats.learn(peer.ip_address, resp.headers)
+
+    if resp.status_code == 200:
+        peer_registry.record_success(peer.ip_address)
+        return peer
+
+    peer_registry.record_failure(peer.ip_address)
+    return None
 
 
 def get_live_peers(servertype):
@@ -126,14 +314,20 @@ def get_live_peers(servertype):
     live_peers = []
     futures = []
 
-    pool = ThreadPoolExecutor(5)  # 5 Worker Threads
-
     # Get all peer's ip address and port from DB
     peer_list = Peers.query.filter_by(server_type=servertype).all()
 
-    # Use check_health() to get whether machine online
+    # Use check_health() only on machines that have not been heard from recently
     for peer in peer_list:
-        futures.append(pool.submit(check_health, peer))
+        status = peer_registry.status(peer.ip_address)
+        if status == ALIVE:
+            live_peers.append(peer)
+        elif status == UNKNOWN:
+            try:
+                futures.append(executor.submit(check_health, peer))
+            except ExecutorFull:
+                # Checked again on the next run
+                app.logger.warning("Outbound queue is full, not checking the health of %s", peer.ip_address)
 
     for x in as_completed(futures):
         result = x.result()
@@ -143,7 +337,7 @@ def get_live_peers(servertype):
     return live_peers
 
 
-def send_block(peer, data, url):
+def send_block(peer, data, url, extra_headers=None):
     """
     A function to send data to target
 
@@ -153,22 +347,38 @@ def send_block(peer, data, url):
     :type data: dict
     :param url: The target link to be sent to
     :type url: str
+    :param extra_headers: Extra headers of the request
+    :type extra_headers: dict
     :return: The response of the request sent
     :rtype:
         - "get" - Response
         - "post" - dict
     """
     url = "http://{}:{}/{}".format(peer.ip_address, peer.port, url)
-    headers = {'Content-type': 'application/json', 'Accept': 'text/plain', "Authorization": "Bearer secret-token-1"}
+    headers = {'Accept': 'text/plain', "Authorization": "Bearer secret-token-1"}
+    headers.update(wire_formats.header())
+    headers.update(extra_headers or {})
+    try:
+        if data == "":
+            r = http_session.get(url, headers=headers, timeout=get_timeout())
+        else:
+            # Sent as JSON until the peer has said it understands more
+            (body, body_headers) = wire_formats.encode(data, wire_formats.shared(peer.ip_address))
+            headers.update(body_headers)
+            r = http_session.post(url, data=body, headers=headers, timeout=get_timeout())
+    except requests.RequestException:
+        peer_registry.record_failure(peer.ip_address)
+        raise
+    peer_registry.record_success(peer.ip_address)
+    wire_formats.learn(peer.ip_address, r.headers)
+
     if data == "":
-        r = requests.get(url, headers=headers, timeout=3)
         return r
     else:
-        r = requests.post(url, json=data, headers=headers, timeout=3)
         try:
-            answer = r.json()
+            answer = decode_response(r)
 
-        except json.decoder.JSONDecodeError:
+        except ValueError:
             answer = r.text
 
         output = {
@@ -189,266 +399,915 @@ These delegates will then verify the hash of the block and return a yes/no respo
 
 def randomselect():
     """
-    This function will select 51 percent of the user in the system for verification of the block
-    
+    This function will select 51 percent of the user in the system for verification of the block, skipping users
+    that are known to be offline
+
     :return: The delegates selected for voting
     :rtype: list
     """
     peer_list = Peers.query.all()
     numberofpeer = len(peer_list)
     fiftyone = math.ceil(numberofpeer * 0.51)
-    delegates = random.sample(peer_list, fiftyone)
+    available_list = [peer for peer in peer_list if peer_registry.is_available(peer.ip_address)]
+    delegates = random.sample(available_list, min(fiftyone, len(available_list)))
     return delegates  # List of user to give their consensus.
 
 
 def sync_schedule():
     """
     Syncing scheduled to run frequently to ensure the database is updated with other nodes
+
+    The case heads of every live node that differ from the local ones are fetched at once and compared with them, a
+    node holding the same case heads only answers that the digests match. The missing blocks of
+    different cases are then fetched concurrently, at most SYNC_PEER_CONCURRENCY cases at a time from each node, in
+    pages of SYNC_PAGE_SIZE blocks handed to the writer as they arrive, so pages fetched together are committed together.
+    A run is skipped while the previous one is still going.
+
+    :return: Number of cases updated, None if the previous run is still going
+    :rtype: int
     """
-    live_peers = get_live_peers("server")
+    if not sync_lock.acquire(blocking=False):
+        return None
+    try:
+        retry_state_digest()
+        live_peers = get_live_peers("server")
+        return fetch_missing_blocks(get_sync_candidates(live_peers))
+    finally:
+        sync_lock.release()
+
+
+def get_sync_candidates(live_peers):
+    """
+    Ask every node for the case heads that differ from the local ones at once and find the cases that other nodes have
+    more blocks of
+
+    :param live_peers: Nodes to ask
+    :type live_peers: list
+    :return: Case ID, request for the missing blocks and the nodes that have them, longest chain first
+    :rtype: list
+    """
+    local_digest = state_digest.snapshot()
+    futures = {}
     for peer in live_peers:
-        # Ask for his length
-        resp = send_block(peer, "", "sync")
-        if resp.status_code != 200:
+        try:
+            futures[executor.submit(fetch_case_heads, peer, local_digest)] = peer
+        except ExecutorFull:
             continue
 
-        resp_json = resp.json()
-        # Make sure json is valid
-        if "Blocks" not in resp_json:
+    # Case ID to length of the case on each node
+    peer_heads = {}
+    for future in as_completed(futures):
+        try:
+            head_list = future.result()
+        except (requests.RequestException, ValueError):
             continue
 
-        # Check length received
-        for length_json in resp_json.get("Blocks"):
-            # Make sure json is valid
+        for length_json in head_list:
             if "id" not in length_json or "length" not in length_json:
                 continue
+            peer_heads.setdefault(length_json["id"], []).append((length_json["length"], futures[future]))
+
+    if not peer_heads:
+        return []
+    case_head_list = CaseHead.query.populate_existing().filter(CaseHead.case_id.in_(list(peer_heads))).all()
+    case_heads = {case_head.case_id: case_head for case_head in case_head_list}
+
+    candidates = []
+    for case_id, head_list in peer_heads.items():
+        case_head = case_heads.get(case_id)
+        if case_head is None:
+            block_count = 0
+            last_hash = ""
+        else:
+            block_count = case_head.length
+            last_hash = case_head.last_hash
 
-            case_id = length_json["id"]
-            block_count = Block.query.filter_by(id=case_id).count()
-            last_hash_block = Block.query.filter_by(id=case_id) \
-                .order_by(Block.block_number.desc()) \
-                .first()
-            if last_hash_block is None:
-                last_hash = ""
-            else:
-                last_hash = last_hash_block.block_hash
+        # Check if longer
+        peers = [peer for (length, peer) in sorted(head_list, key=lambda head: head[0], reverse=True)
+                 if length > block_count]
+        if peers:
+            candidates.append((case_id, {"id": case_id, "length": block_count, "last": last_hash}, peers))
+    return candidates
 
-            # Check if longer
-            if length_json["length"] <= block_count:
-                continue
 
-            resp = send_block(peer, {"id": case_id, "length": block_count, "last": last_hash}, "sync")
+def fetch_case_heads(peer, local_digest):
+    """
+    Return the case heads of a node that may differ from the local ones
 
-            if resp["Status_Code"] == 200:
-                resp_json = resp["Answer"]
-                for block_json in resp_json.get("Blocks"):
-                    block = convert_to_block(block_json)
-                    db.session.add(block)
+    The local digest is sent as If-None-Match, so a node with the same case heads answers 304 Not Modified without a
+    body. Otherwise it sends its bucket digests and only the case heads of the buckets that differ are asked for. Nodes
+    without /digest send every case head.
 
-                    # Load string as json
-                    log_json = json.loads(block.log)
+    :param peer: Node to ask
+    :type peer: Peers
+    :param local_digest: Digest and bucket digests of this node, from StateDigest.snapshot
+    :type local_digest: tuple
+    :return: Case ID, length and last block hash of the cases
+    :rtype: list
+    :raises requests.RequestException: If the node cannot be reached
+    :raises ValueError: If a response cannot be decoded
+    """
+    (digest, bucket_digests) = local_digest
+    resp = send_block(peer, "", "digest", {"If-None-Match": quote_etag(digest)})
+    if resp.status_code == 304:
+        return []
+
+    url = "sync"
+    if resp.status_code == 200:
+        resp_json = decode_response(resp)
+        if not isinstance(resp_json, dict) or not isinstance(resp_json.get("Buckets"), list):
+            return []
+        bucket_list = differing_buckets(bucket_digests, resp_json["Buckets"])
+        if not bucket_list:
+            return []
+        if len(bucket_list) < BUCKETS:
+            url = "sync?buckets=" + ",".join(str(bucket) for bucket in bucket_list)
+
+    resp = send_block(peer, "", url)
+    if resp.status_code != 200:
+        return []
+    resp_json = decode_response(resp)
+    # Make sure json is valid
+    if not isinstance(resp_json, dict) or not isinstance(resp_json.get("Blocks"), list):
+        return []
+    return resp_json["Blocks"]
+
+
+def load_state_digest():
+    """
+    Fill the state digest with the head of every case, once the database is built
+    """
+    table = CaseHead.__table__
+    with read_engine.connect() as connection:
+        state_digest.load(connection.execute(select(table.c.case_id, table.c.length, table.c.last_hash)))
+
+
+@on_block_commit
+def refresh_state_digest(case_id_set):
+    """
+    Update the state digest with the new heads of the cases that blocks were committed to
+
+    This runs in the commit hook of the writer, so it never raises. Cases whose heads cannot be read are left to
+    retry_state_digest.
 
-                    # Check log action add user
-                    if "AddUser" == log_json["Action"]:
-                        user_list = log_json["Username"]
-                        for user in user_list:
-                            # Check exist
-                            test = UserCase.query \
-                                .filter_by(username=user, case_id=block.id) \
-                                .first()
-                            if test is not None:
-                                continue
+    :param case_id_set: Case ID of the cases
+    :type case_id_set: set
+    """
+    table = CaseHead.__table__
+    with digest_lock:
+        try:
+            with read_engine.connect() as connection:
+                rows = connection.execute(select(table.c.case_id, table.c.length, table.c.last_hash)
+                                          .where(table.c.case_id.in_(list(case_id_set)))).all()
+        except Exception:
+            app.logger.exception("Could not read the heads of %s cases for the state digest", len(case_id_set))
+            stale_digest_cases.update(case_id_set)
+            return
+        stale_digest_cases.difference_update(case_id_set)
+        for (case_id, length, last_hash) in rows:
+            state_digest.update(case_id, length, last_hash)
+
+
+def retry_state_digest():
+    """
+    Read the heads of the cases refresh_state_digest could not read again
+    """
+    with digest_lock:
+        case_id_set = set(stale_digest_cases)
+    if case_id_set:
+        refresh_state_digest(case_id_set)
 
-                            # Add User to case
-                            usercase = UserCase(user, block.id)
-                            db.session.add(usercase)
 
-                # If verified add to block, else discard
-                if verify(case_id):
-                    db.session.commit()
-                else:
-                    db.session.rollback()
+def fetch_missing_blocks(candidates):
+    """
+    Fetch the missing blocks of cases concurrently and add them through the writer
 
+    A case is fetched from the node with the longest chain, and from the next one if that request fails. A case that
+    fails in any other way is left for the next run without stopping the others.
 
-def send_new_verified_to_clients(add_the_block):
+    :param candidates: Case ID, request for the missing blocks and the nodes that have them, from get_sync_candidates
+    :type candidates: list
+    :return: Number of cases updated
+    :rtype: int
     """
-    Sends new blocks to all clients.
+    limit = app.config["SYNC_PEER_CONCURRENCY"]
+    waiting = list(candidates)
+    running = {}
+    in_flight = {}
+    updated = 0
+    while waiting or running:
+        # Start the fetches whose node has a free slot
+        still_waiting = []
+        for (case_id, data, peers) in waiting:
+            ip_address = peers[0].ip_address
+            if in_flight.get(ip_address, 0) >= limit:
+                still_waiting.append((case_id, data, peers))
+                continue
+            try:
+                future = executor.submit(sync_case, peers[0], data)
+            except ExecutorFull:
+                still_waiting.append((case_id, data, peers))
+                continue
+            running[future] = (case_id, data, peers)
+            in_flight[ip_address] = in_flight.get(ip_address, 0) + 1
+        waiting = still_waiting
+        if not running:
+            # The executor stayed full, the remaining cases are synced next run
+            break
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            (case_id, data, peers) = running.pop(future)
+            in_flight[peers[0].ip_address] -= 1
+            try:
+                added = future.result()
+            except ChainVerificationFailed:
+                continue
+            except requests.RequestException:
+                added = None
+            except Exception:
+                # A malformed answer or a page overlapping blocks added meanwhile only fails this case
+                app.logger.exception("Syncing case %s from %s failed", case_id, peers[0].ip_address)
+                added = None
+
+            if added:
+                updated += 1
+            elif added is None and len(peers) > 1:
+                # Carry on from the last page added with the next node
+                waiting.append((case_id, data, peers[1:]))
+    return updated
+
+
+def sync_case(peer, data):
+    """
+    Fetch the missing blocks of a case from a node a page at a time, adding every page through the writer before
+    asking for the next
 
-    :param add_the_block: The new verified block
-    :type add_the_block: Block
+    data is moved past every page added, so another node can carry on from there if a request fails.
+
+    :param peer: Node to fetch from
+    :type peer: Peers
+    :param data: Request for the missing blocks, the case ID, length and last hash of the case
+    :type data: dict
+    :return: Number of blocks added, None if the node did not answer with blocks
+    :rtype: int
+    :raises requests.RequestException: If a request fails
+    :raises ChainVerificationFailed: If the case does not verify with a page
     """
-    pool = ThreadPoolExecutor(5)  # 5 Worker Threads
+    added = 0
+    while True:
+        resp = send_block(peer, dict(data, limit=app.config["SYNC_PAGE_SIZE"]), "sync")
+        if resp["Status_Code"] != 200 or not isinstance(resp["Answer"], dict):
+            return added or None
+        block_json_list = resp["Answer"].get("Blocks")
+        if not block_json_list:
+            return added or None
+
+        # Nodes without pages send every block newest first and no next length
+        block_json_list = sorted(block_json_list, key=lambda block_json: block_json["block_number"])
+        writer.call(add_synced_blocks, data["id"], block_json_list)
+        added += len(block_json_list)
+        data["length"] = block_json_list[-1]["block_number"] + 1
+        data["last"] = block_json_list[-1]["block_hash"]
+
+        next_length = resp["Answer"].get("next")
+        if next_length is None or next_length < data["length"]:
+            return added
+
+
+def add_synced_blocks(session, case_id, block_json_list):
+    """
+    Writer job that adds the blocks of a case received from another node, if the case still verifies with them
+
+    :param session: Session of the writer
+    :type session: Session
+    :param case_id: ID of the case
+    :type case_id: str
+    :param block_json_list: Blocks missing from the case
+    :type block_json_list: list
+    :raises ChainVerificationFailed: If the case does not verify with the blocks added
+    """
+    for block_json in block_json_list:
+        block = convert_to_block(block_json)
+        session.add(block)
+
+        # Load string as json
+        log_json = json.loads(block.log)
+
+        # Check log action add user
+        if "AddUser" == log_json["Action"]:
+            user_list = log_json["Username"]
+            for user in user_list:
+                # Check exist
+                test = session.query(UserCase) \
+                    .filter_by(username=user, case_id=block.id) \
+                    .first()
+                if test is not None:
+                    continue
+
+                # Add User to case
+                usercase = UserCase(user, block.id)
+                session.add(usercase)
+
+    (verified, last_block) = verify_chain(session, case_id)
+    if not verified:
+        raise ChainVerificationFailed(case_id)
+    if last_block is not None:
+        move_checkpoint(session, case_id, last_block.block_number, last_block.block_hash)
+
+
+def send_new_verified_to_clients(block_list):
+    """
+    Sends new blocks to all clients.
 
-    data = {
+    :param block_list: The new verified blocks, in order within each case
+    :type block_list: list
+    """
+    update_list = [{
         "case_id": add_the_block.id,
         "previous_hash": add_the_block.previous_block_hash,
         "last_verified_hash": add_the_block.block_hash,
         "length": add_the_block.block_number + 1
-    }
+    } for add_the_block in block_list]
+    # A single block is sent on its own so clients that only know that form can apply it
+    data = update_list[0] if len(update_list) == 1 else {"Blocks": update_list}
     client_list = Peers.query.filter_by(server_type="client").all()
     for client in client_list:
-        pool.submit(send_block, client, data, "sync")
+        # Offline clients catch up through their own sync
+        if peer_registry.is_available(client.ip_address):
+            try:
+                # Never holds up the request that added the blocks
+                executor.try_submit(send_block, client, data, "sync")
+            except ExecutorFull:
+                app.logger.warning("Outbound queue is full, %s will get the new blocks through /sync",
+                                   client.ip_address)
 
 
 # !!! Native SQLAlchemy Syntax !!!
+def get_vote_threshold(session):
+    """
+    Return the number of positive votes a block needs to be added, 2/3 of the 51 percent of clients selected
+
+    :param session: Session to query with
+    :type session: Session
+    :return: Number of positive votes needed
+    :rtype: int
+    """
+    numberofpeer = session.query(Peers).filter(Peers.server_type == "client").count()
+    selectnumber = math.ceil(numberofpeer * 0.51)
+    return math.ceil(selectnumber * 0.66)
+
+
 def check_twothird():
     """
     A scheduled function to check if unverified block have meet the requirements and those that meet the requirements
     gets added as a block
+
+    Blocks are normally added as soon as their votes arrive, this catches the votes the in-memory tally has missed
     """
     session = Session()
+    twothird = get_vote_threshold(session)
+
+    # Count the positive votes of every unverified block still within its voting time in one query
+    passed_list = session.query(Pool.id) \
+        .join(Consensus, Consensus.pool_id == cast(Pool.id, String)) \
+        .filter(Pool.sendout_time >= datetime.now() - timedelta(seconds=TIMEOUT), Consensus.response == 1) \
+        .group_by(Consensus.pool_id) \
+        .having(func.count(Consensus.consensus_id) >= twothird) \
+        .order_by(Pool.id) \
+        .all()
+    Session.remove()
+
+    add_passed_blocks([pool_id for (pool_id,) in passed_list])
+
+
+def add_passed_blocks(pool_id_list):
+    """
+    Add the unverified blocks that have enough votes to the blockchain
+
+    :param pool_id_list: ID of the unverified blocks
+    :type pool_id_list: list
+    """
+    added_list = writer.call(add_verified_pools, pool_id_list)
+    for (block_list, removed_id_list, rehashed_id_list) in added_list:
+        vote_tally.discard(removed_id_list + rehashed_id_list)
+
+        # The oldest remaining block of the case is voted on next
+        if rehashed_id_list:
+            pool_deadlines.schedule(min(rehashed_id_list), datetime.now())
 
-    # Get all Unverified Blocks
-    pool_list = session.query(Pool).all()
-    for pool in pool_list:
-        if pool.sendout_time is None:
+        # Sending new verified blocks to clients
+        if block_list:
+            send_new_verified_to_clients(block_list)
+
+
+def add_verified_pools(session, pool_id_list):
+    """
+    Writer job that adds the unverified blocks that have enough votes to the blockchain
+
+    :param session: Session of the writer
+    :type session: Session
+    :param pool_id_list: ID of the unverified blocks
+    :type pool_id_list: list
+    :return: Result of add_verified_blocks for every block or segment added
+    :rtype: list
+    """
+    added_list = []
+    for pool_id in sorted(pool_id_list):
+        verified_block = session.query(Pool).filter(Pool.id == pool_id).first()
+
+        # Already added, or rehashed after another block of the case was added
+        if verified_block is None or verified_block.sendout_time is None:
             continue
 
-        # If Unverified block Timed Out, Check all response to check if 2/3
-        if pool.sendout_time + timedelta(seconds=TIMEOUT) >= datetime.now():
-            # Check if id has 2/3 >, add to block
-            numberofpeer = len(session.query(Peers).filter(Peers.server_type == "client").all())
-            selectnumber = math.ceil(numberofpeer * 0.51)
-            twothird = math.ceil(selectnumber * 0.66)
-            consensus_list = session.query(Consensus) \
-                .filter(Consensus.pool_id == pool.id, Consensus.response == 1) \
-                .all()
-            number_of_consensuses = [x for x in consensus_list if x.response]
-            if len(number_of_consensuses) >= twothird:
-                verified_block = session.query(Pool).filter(Pool.id == pool.id).first()
-                temp = verified_block.case_id  # Store a temp value
-
-                add_the_block = Block(
-                    id=verified_block.case_id,
-                    meta_data=verified_block.meta_data,
-                    log=verified_block.log,
-                    block_hash=verified_block.block_hash,
-                    timestamp=verified_block.timestamp,
-                    status=1
-                )
-
-                session.add(add_the_block)
-                remove_old_pool = session.query(Pool).filter(Pool.id == verified_block.id).first()
-                session.delete(remove_old_pool)
-                consensus_list = session.query(Consensus).filter(Consensus.pool_id == verified_block.id).all()
-                for remove_consensus in consensus_list:
-                    session.delete(remove_consensus)
-                session.commit()
-
-                # Resetting the count of the pool after the previous pool is verified
-                update_pool = session.query(Pool).filter(Pool.case_id == temp).all()
-
-                last_hash_block = Block.query.filter_by(id=temp).order_by(Block.block_number.desc()).first()
-                if update_pool is not None:
-                    for all_pool in update_pool:
-                        all_consensus = session.query(Consensus).filter(Consensus.pool_id == all_pool.id).all()
-                        # Changing the first block in the pool with same case ID with the latest block's black_hash
-                        for x in all_consensus:
-                            session.delete(x)
-
-                        all_pool.previous_block_hash = last_hash_block.block_hash
-                        all_pool.block_number = last_hash_block.block_number + 1
-                        block_data = all_pool.case_id + "-" + str(all_pool.block_number) + "-" + all_pool.meta_data + \
-                                     "-" + all_pool.log + "-" + str(all_pool.timestamp) + "-" + all_pool.previous_block_hash
-
-                        all_pool.block_hash = hashlib.sha256(block_data.encode()).hexdigest()
-                        all_pool.sendout_time = None
-                        all_pool.count = 0
-
-                        session.commit()
-
-                # Sending new verified blocks to clients
-                send_new_verified_to_clients(add_the_block)
-
-                # Load string as json
-                log_json = json.loads(verified_block.log)
-
-                # Check log action add user
-                if "AddUser" == log_json["Action"]:
-                    user_list = log_json["Username"]
-                    for user in user_list:
-                        # Check exist
-                        test = session.query(UserCase) \
-                            .filter(UserCase.username == user, UserCase.case_id == verified_block.case_id) \
-                            .first()
-                        if test is not None:
-                            continue
-
-                        # Add User to case
-                        usercase = UserCase(user, verified_block.case_id)
-                        session.add(usercase)
-                    session.commit()
+        # The case was extended by a sync since the block was hashed, adding it would break the chain, so the pool of
+        # the case is rehashed on top of the new last block and voted on again
+        case_head = session.query(CaseHead).filter(CaseHead.case_id == verified_block.case_id).first()
+        last_hash = "" if case_head is None else case_head.last_hash
+        if verified_block.previous_block_hash != last_hash:
+            length = 0 if case_head is None else case_head.length
+            app.logger.warning("Case %s has moved past unverified block %s, rehashing its pool",
+                               verified_block.case_id, verified_block.id)
+            added_list.append(([], [], rehash_case_pool(session, verified_block.case_id, last_hash, length)))
+            continue
+        added_list.append(add_verified_blocks(session, get_segment(session, verified_block)))
+    return added_list
 
-    Session.remove()
+
+def add_verified_blocks(session, verified_list):
+    """
+    Move unverified blocks of a case that have enough votes into the blockchain and rehash the rest of its case's pool
+
+    :param session: Session of the writer
+    :type session: Session
+    :param verified_list: Unverified blocks that passed, chained after each other
+    :type verified_list: list
+    :return: Blocks added, ID of the unverified blocks removed and ID of the unverified blocks rehashed
+    :rtype: tuple
+    """
+    temp = verified_list[0].case_id  # Store a temp value
+    log_list = [json.loads(verified_block.log) for verified_block in verified_list]
+
+    block_list = []
+    for verified_block in verified_list:
+        add_the_block = Block(
+            id=verified_block.case_id,
+            meta_data=verified_block.meta_data,
+            log=verified_block.log,
+            block_number=verified_block.block_number,
+            previous_block_hash=verified_block.previous_block_hash,
+            block_hash=verified_block.block_hash,
+            timestamp=verified_block.timestamp,
+            status=1
+        )
+        session.add(add_the_block)
+        session.delete(verified_block)
+        block_list.append(add_the_block)
+    verified_id_list = [verified_block.id for verified_block in verified_list]
+    session.query(Consensus) \
+        .filter(Consensus.pool_id.in_([str(pool_id) for pool_id in verified_id_list])) \
+        .delete(synchronize_session=False)
+
+    # Resetting the count of the pool after the previous pool is verified
+    last_hash_block = block_list[-1]
+    pool_id_list = rehash_case_pool(session, temp, last_hash_block.block_hash, last_hash_block.block_number + 1)
+
+    for log_json in log_list:
+        # Check log action add user
+        if "AddUser" == log_json["Action"]:
+            user_list = log_json["Username"]
+            for user in user_list:
+                # Check exist
+                test = session.query(UserCase) \
+                    .filter(UserCase.username == user, UserCase.case_id == temp) \
+                    .first()
+                if test is not None:
+                    continue
+
+                # Add User to case
+                usercase = UserCase(user, temp)
+                session.add(usercase)
+
+    return block_list, verified_id_list, pool_id_list
+
+
+def rehash_case_pool(session, case_id, last_hash, block_number):
+    """
+    Chain the unverified blocks of a case after its last block again, so they are sent out and voted on anew
+
+    :param session: Session of the writer
+    :type session: Session
+    :param case_id: Case ID of the case
+    :type case_id: str
+    :param last_hash: Block hash of the last block of the case
+    :type last_hash: str
+    :param block_number: Block number following the last block of the case
+    :type block_number: int
+    :return: ID of the unverified blocks rehashed
+    :rtype: list
+    """
+    update_pool = session.query(Pool).filter(Pool.case_id == case_id).all()
+    for all_pool in update_pool:
+        # Changing the first block in the pool with same case ID with the latest block's black_hash
+        all_pool.previous_block_hash = last_hash
+        all_pool.block_number = block_number
+        all_pool.block_hash = hash_pool(all_pool)
+        all_pool.sendout_time = None
+        all_pool.count = 0
+        all_pool.segment_id = None
+
+    # Votes of the rehashed blocks are no longer valid
+    pool_id_list = [all_pool.id for all_pool in update_pool]
+    session.query(Consensus) \
+        .filter(Consensus.pool_id.in_([str(pool_id) for pool_id in pool_id_list])) \
+        .delete(synchronize_session=False)
+    return pool_id_list
+
+
+def hash_pool(pool):
+    """
+    Hash an unverified block from its content and position in the chain
+
+    :param pool: Unverified block
+    :type pool: Pool
+    :return: Hash of the block
+    :rtype: str
+    """
+    block_data = pool.case_id + "-" + str(pool.block_number) + "-" + pool.meta_data + \
+                 "-" + pool.log + "-" + str(pool.timestamp) + "-" + pool.previous_block_hash
+    return hashlib.sha256(block_data.encode()).hexdigest()
+
+
+def get_segment(session, head):
+    """
+    Return the unverified blocks that are voted on together with the head of a case, in chain order
+
+    :param session: Session to query with
+    :type session: Session
+    :param head: Oldest unverified block of the case
+    :type head: Pool
+    :return: Unverified blocks of the segment
+    :rtype: list
+    """
+    if head.segment_id is None:
+        return [head]
+    return session.query(Pool).filter(Pool.segment_id == head.id).order_by(Pool.block_number).all()
+
+
+def form_segment(session, head):
+    """
+    Chain the oldest unverified blocks of a case after each other, so delegates can verify them in one pass and they
+    are added together once the head has enough votes
+
+    :param session: Session to query with
+    :type session: Session
+    :param head: Oldest unverified block of the case
+    :type head: Pool
+    :return: Unverified blocks of the segment
+    :rtype: list
+    """
+    segment = session.query(Pool) \
+        .filter(Pool.case_id == head.case_id) \
+        .order_by(Pool.id) \
+        .limit(app.config["SEGMENT_MAX_SIZE"]) \
+        .all()
+    previous = None
+    for block in segment:
+        if previous is not None:
+            block.block_number = previous.block_number + 1
+            block.previous_block_hash = previous.block_hash
+            block.block_hash = hash_pool(block)
+        block.segment_id = head.id
+        previous = block
+    return segment
+
+
+def hash_block(block):
+    """
+    Recalculate the hash of a stored block
+
+    :param block: Block to hash
+    :type block: Block
+    :return: SHA-256 hex digest of the block's content
+    :rtype: str
+    """
+    data = block.id + "-" + str(block.block_number) + "-" + block.meta_data + "-" + block.log + "-" + \
+           str(block.timestamp) + "-" + block.previous_block_hash
+    return hashlib.sha256(data.encode()).hexdigest()
 
 
 def verify(case_id):
     """
-    A function used to verify if the case id exist in the system. 
+    A function used to verify if the case id exist in the system.
+
+    A case that still ends with the block it ended with when last verified is not verified again. Otherwise only blocks
+    appended after the case's checkpoint are re-hashed, the checkpoint is then moved to the last block. Nothing is
+    committed here, and blocks of the case the caller has added but not committed are verified without being
+    remembered, since the caller's transaction may still be rolled back.
 
     :param case_id: case_id in the table
     :type case_id: str
     :return: A true/false statement on whether the case id exist
-    :rtype: Boolean 
+    :rtype: Boolean
     """
-    blocks = Block.query.filter_by(id=case_id).order_by(Block.block_number.asc()).all()
-    previous_block_hash = ""
+    case_head = db.session.query(CaseHead).populate_existing().filter_by(case_id=case_id).first()
+    if case_head is not None and verified_heads.get(case_id) == case_head.last_hash:
+        return True
+
+    (verified, last_block) = verify_chain(db.session, case_id)
+    if not verified:
+        verified_heads.pop(case_id, None)
+        return False
+    if case_id in db.session.info.get("changed_cases", ()):
+        return True
+    if case_head is not None:
+        verified_heads[case_id] = case_head.last_hash
+
+    # Moving the checkpoint does not hold up the caller
+    if last_block is not None:
+        writer.submit(move_checkpoint, case_id, last_block.block_number, last_block.block_hash)
+    return True
+
+
+def verify_cases(case_id_list):
+    """
+    Verify a list of cases, looking up the last block of all of them at once so cases that have not changed since
+    they were last verified cost nothing more
+
+    :param case_id_list: case_id of the cases
+    :type case_id_list: list
+    :return: Whether every case is verified
+    :rtype: Boolean
+    """
+    case_head_list = db.session.query(CaseHead.case_id, CaseHead.last_hash) \
+        .filter(CaseHead.case_id.in_(case_id_list)) \
+        .all()
+    unchanged = {case_id for (case_id, last_hash) in case_head_list if verified_heads.get(case_id) == last_hash}
+    return all(verify(case_id) for case_id in case_id_list if case_id not in unchanged)
+
+
+def verify_chain(session, case_id):
+    """
+    Verify the blocks of a case appended after its checkpoint
+
+    :param session: Session to read the blocks with
+    :type session: Session
+    :param case_id: case_id in the table
+    :type case_id: str
+    :return: Whether the case is verified, and the last block if the checkpoint can be moved to it
+    :rtype: tuple
+    """
+    checkpoint = session.query(Checkpoint).populate_existing().filter_by(case_id=case_id).first()
+    if checkpoint is None:
+        start = 0
+        previous_block_hash = ""
+    else:
+        # Make sure the checkpointed block has not been altered since it was verified
+        checkpoint_block = session.query(Block).filter_by(id=case_id, block_number=checkpoint.block_number).first()
+        if checkpoint_block is None or hash_block(checkpoint_block) != checkpoint.block_hash:
+            return False, None
+        start = checkpoint.block_number + 1
+        previous_block_hash = checkpoint.block_hash
+
+    blocks = session.query(Block).filter(Block.id == case_id, Block.block_number >= start) \
+        .order_by(Block.block_number.asc()) \
+        .all()
     for block in blocks:
         if previous_block_hash != block.previous_block_hash:
-            return False
+            return False, None
 
-        data = block.id + "-" + str(block.block_number) + "-" + block.meta_data + "-" + block.log + "-" + \
-               str(block.timestamp) + "-" + block.previous_block_hash
-        block_hash = hashlib.sha256(data.encode()).hexdigest()
+        block_hash = hash_block(block)
         if block_hash != block.block_hash:
-            return False
+            return False, None
         previous_block_hash = block_hash
-    return True
+
+    if len(blocks) > 0:
+        return True, blocks[-1]
+    return True, None
+
+
+def get_inclusion_proof(session, case_id, block_number, tree_size=None):
+    """
+    Return the Merkle inclusion proof of a block, checked with merkle.verify_inclusion
+
+    :param session: Session to read with
+    :type session: Session
+    :param case_id: case_id of the block
+    :type case_id: str
+    :param block_number: Block number of the block
+    :type block_number: int
+    :param tree_size: Length of the case to prove against, the current length if None
+    :type tree_size: int
+    :return: Block hash, tree size, root and proof, None if the block or tree is not found
+    :rtype: dict
+    """
+    case_head = session.query(CaseHead).filter_by(case_id=case_id).first()
+    if case_head is None:
+        return None
+    if tree_size is None:
+        tree_size = case_head.length
+    if not 0 <= block_number < tree_size <= case_head.length:
+        return None
+
+    keys = proof_keys(block_number, tree_size)
+    node_list = session.query(MerkleNode.level, MerkleNode.position, MerkleNode.hash) \
+        .filter(MerkleNode.case_id == case_id,
+                or_(*[and_(MerkleNode.level == level, MerkleNode.position == position) for (level, position) in keys])) \
+        .all()
+    nodes = {(level, position): node for (level, position, node) in node_list}
+    block = session.query(Block).filter_by(id=case_id, block_number=block_number).first()
+    if block is None or len(nodes) != len(keys):
+        return None
+
+    return {
+        "case_id": case_id,
+        "block_number": block_number,
+        "block_hash": block.block_hash,
+        "tree_size": tree_size,
+        "root": subtree_hash(nodes, 0, tree_size),
+        "proof": [subtree_hash(nodes, start, size) for (start, size) in proof_subtrees(block_number, 0, tree_size)]
+    }
+
+
+def move_checkpoint(session, case_id, block_number, block_hash):
+    """
+    Writer job that moves the checkpoint of a case to a verified block, never moving it back
+
+    :param session: Session of the writer
+    :type session: Session
+    :param case_id: case_id in the table
+    :type case_id: str
+    :param block_number: Block number of the last verified block
+    :type block_number: int
+    :param block_hash: Block hash of the last verified block
+    :type block_hash: str
+    """
+    table = Checkpoint.__table__
+    statement = insert(table).values(case_id=case_id, block_number=block_number, block_hash=block_hash)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.case_id],
+        set_={"block_number": statement.excluded.block_number, "block_hash": statement.excluded.block_hash},
+        where=table.c.block_number < statement.excluded.block_number
+    )
+    session.execute(statement)
+
+
+def warm_up_checkpoints():
+    """
+    Verify every case once at startup so requests only need to verify blocks added afterwards
+    """
+    id_list = Block.query.with_entities(Block.id).distinct().all()
+    for (case_id,) in id_list:
+        verify(case_id)
 
 
 # !!! Native SQLAlchemy Syntax !!!
-def send_unverified_block():
+def rebuild_pool_deadlines():
     """
-    A scheduled function that sends unverified blocks in the pool to the selected delegates for them to vote if the block should be added to the 
-    block. 
+    Fill the deadline queue from the pool at startup, the oldest unverified block of every case is due when its
+    voting time runs out or straight away if it has not been sent out
     """
     session = Session()
+    now = datetime.now()
+    head_list = session.query(Pool.id, Pool.sendout_time) \
+        .filter(Pool.id.in_(select(func.min(Pool.id)).group_by(Pool.case_id))) \
+        .all()
+    for (pool_id, sendout_time) in head_list:
+        if sendout_time is None:
+            pool_deadlines.schedule(pool_id, now)
+        else:
+            pool_deadlines.schedule(pool_id, sendout_time + timedelta(seconds=TIMEOUT))
+    Session.remove()
+
 
-    # Every 10 Second
-    list_of_unverified = session.query(Pool).order_by(Pool.case_id).all()
+# !!! Native SQLAlchemy Syntax !!!
+def send_unverified_block():
+    """
+    A scheduled function that sends unverified blocks in the pool to the selected delegates for them to vote if the block should be added to the
+    block. Blocks of different cases are voted on in parallel, blocks of the same case one at a time in order of arrival, or as one
+    segment when SEGMENT_CONSENSUS is set.
+
+    Only the blocks due in the deadline queue are looked at. A block is resent every TIMEOUT seconds until it has been
+    sent out 3 times, after which it is removed. A block whose status is set is held back and looked at again every
+    TIMEOUT seconds.
+    """
+    now = datetime.now()
+    due_id_list = pool_deadlines.pop_due(now)
+    if not due_id_list:
+        return
+
+    try:
+        (due_list, sent_id_list, held_id_list, expired_id_list, next_head_list) = \
+            writer.call(send_out_pools, due_id_list, now)
+    except Exception:
+        # Try again on the next run
+        for pool_id in due_id_list:
+            pool_deadlines.schedule(pool_id, now)
+        raise
+    vote_tally.discard(expired_id_list)
+    for pool_id in sent_id_list + held_id_list:
+        pool_deadlines.schedule(pool_id, now + timedelta(seconds=TIMEOUT))
+    for pool_id in next_head_list:
+        pool_deadlines.schedule(pool_id, now)
+
+    # Send the blocks due this round to every user, one request per batch, never splitting a segment
     list_of_users = randomselect()
-    thread_pool = ThreadPoolExecutor(5)  # 5 Worker Threads
-    for block in list_of_unverified:
-        data = {"Pool": [
-            {"id": block.id, "case_id": block.case_id, "block_number": block.block_number, "meta_data": block.meta_data,
-             "log": block.log,
-             "timestamp": str(block.timestamp),
-             "previous_block_hash": block.previous_block_hash, "block_hash": block.block_hash}]
-        }
+    batch_size = app.config["POOL_BATCH_SIZE"]
+    batch_list = [[]]
+    for segment in due_list:
+        if batch_list[-1] and len(batch_list[-1]) + len(segment) > batch_size:
+            batch_list.append([])
+        batch_list[-1].extend(segment)
+    for batch in batch_list:
+        if not batch:
+            continue
+        data = {"Pool": batch}
+        for peer in list_of_users:
+            try:
+                executor.submit(send_block, peer, data, "receivepool")  # send block to user
+            except ExecutorFull:
+                # The blocks are sent out again once they time out
+                app.logger.warning("Outbound queue is full, not sending unverified blocks to %s", peer.ip_address)
+
+
+def send_out_pools(session, due_id_list, now):
+    """
+    Writer job that marks the due unverified blocks as sent out, or removes them once they have been sent out 3 times
+
+    :param session: Session of the writer
+    :type session: Session
+    :param due_id_list: ID of the unverified blocks that are due
+    :type due_id_list: list
+    :param now: Time the blocks are sent out
+    :type now: datetime
+    :return: Segments to send out, ID of the blocks sent out, ID of the blocks held back by their status, ID of the
+        blocks removed and ID of the blocks that are now the oldest of their case
+    :rtype: tuple
+    """
+    due_pool_list = session.query(Pool).filter(Pool.id.in_(due_id_list)).order_by(Pool.id).all()
+
+    # Blocks behind an older block of their case wait until it is added, they are queued again then
+    case_list = list({block.case_id for block in due_pool_list})
+    head_of_case = dict(session.query(Pool.case_id, func.min(Pool.id))
+                        .filter(Pool.case_id.in_(case_list))
+                        .group_by(Pool.case_id)
+                        .all())
+
+    due_list = []
+    sent_id_list = []
+    held_id_list = []
+    expired_id_list = []
+    expired_case_list = []
+    for block in due_pool_list:
+        if head_of_case.get(block.case_id) != block.id:
+            continue
         if block.sendout_time is None:
-            block.sendout_time = datetime.now()
-            block.count = 0
-            session.commit()
-            for peer in list_of_users:
-                thread_pool.submit(send_block, peer, data, "receivepool")  # send block to user
-        else:
-            if block.status:
-                pass
-                # interrupt schedule and move on
+            if app.config["SEGMENT_CONSENSUS"]:
+                segment = form_segment(session, block)
             else:
-                if block.count < 3:
-                    block.count += 1  # increment count
-                    if (block.sendout_time + timedelta(seconds=TIMEOUT)) <= datetime.now():
-                        block.sendout_time = datetime.now()
-                        session.commit()
-
-                        for peer in list_of_users:
-                            thread_pool.submit(send_block, peer, data, "receivepool")  # send block to user
-                else:
-                    session.delete(block)
-                    consensus_list = session.query(Consensus).filter(Consensus.pool_id == block.id).all()
-                    for remove_consensus in consensus_list:
-                        session.delete(remove_consensus)
-                    session.commit()
+                segment = [block]
+            block.sendout_time = now
+            block.count = 1
+            due_list.append([convert_pool_to_data(pool) for pool in segment])
+            sent_id_list.append(block.id)
+        elif block.status:
+            # interrupt schedule and move on, the block is looked at again after the next timeout
+            held_id_list.append(block.id)
+        elif block.count < 3:
+            block.count += 1  # increment count
+            block.sendout_time = now
+            due_list.append([convert_pool_to_data(pool) for pool in get_segment(session, block)])
+            sent_id_list.append(block.id)
+        else:
+            expired_id_list.extend(pool.id for pool in get_segment(session, block))
+            expired_case_list.append(block.case_id)
+
+    # Remove the expired blocks and their votes in bulk
+    next_head_list = []
+    if expired_id_list:
+        session.query(Pool).filter(Pool.id.in_(expired_id_list)).delete(synchronize_session=False)
+        session.query(Consensus) \
+            .filter(Consensus.pool_id.in_([str(pool_id) for pool_id in expired_id_list])) \
+            .delete(synchronize_session=False)
+        next_head_list = [pool_id for (pool_id,) in session.query(func.min(Pool.id))
+                          .filter(Pool.case_id.in_(expired_case_list))
+                          .group_by(Pool.case_id)
+                          .all()]
+    return due_list, sent_id_list, held_id_list, expired_id_list, next_head_list
+
+
+def convert_pool_to_data(block):
+    """
+    Convert an unverified block into the dict sent to delegates
 
-    Session.remove()
+    :param block: Unverified block
+    :type block: Pool
+    :return: Unverified block as dict
+    :rtype: dict
+    """
+    return {"id": block.id, "case_id": block.case_id, "block_number": block.block_number,
+            "meta_data": block.meta_data,
+            "log": block.log,
+            "timestamp": str(block.timestamp),
+            "previous_block_hash": block.previous_block_hash, "block_hash": block.block_hash,
+            "segment_id": block.segment_id}
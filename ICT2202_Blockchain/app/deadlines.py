@@ -0,0 +1,59 @@
+"""
+deadlines.py
+============
+In-memory queue of when every unverified block is next due to be sent out, resent or removed
+"""
+import heapq
+import threading
+
+
+class DeadlineQueue:
+    """
+    Keeps the unverified blocks ordered by deadline, so the scheduled job only touches the blocks that are due
+
+    Scheduling a block again replaces its deadline, the old entry is skipped when it comes out of the heap. The queue
+    is lost on restart and rebuilt from the pool.
+    """
+
+    def __init__(self):
+        """
+        Init function of DeadlineQueue Class
+        """
+        self.lock = threading.Lock()
+        self.heap = []
+        self.deadlines = {}
+
+    def __len__(self):
+        with self.lock:
+            return len(self.deadlines)
+
+    def schedule(self, pool_id, deadline):
+        """
+        Set when the unverified block is next due
+
+        :param pool_id: ID of the unverified block
+        :type pool_id: int
+        :param deadline: Time the block is due
+        :type deadline: datetime
+        """
+        with self.lock:
+            self.deadlines[pool_id] = deadline
+            heapq.heappush(self.heap, (deadline, pool_id))
+
+    def pop_due(self, now):
+        """
+        Remove and return the unverified blocks that are due
+
+        :param now: Current time
+        :type now: datetime
+        :return: ID of the unverified blocks, earliest deadline first
+        :rtype: list
+        """
+        due_list = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                deadline, pool_id = heapq.heappop(self.heap)
+                if self.deadlines.get(pool_id) == deadline:
+                    del self.deadlines[pool_id]
+                    due_list.append(pool_id)
+        return due_list
@@ -0,0 +1,145 @@
+"""
+executor.py
+===========
+Process wide worker pool for outbound requests
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ExecutorFull(Exception):
+    """
+    Raised when the queue of the executor stays full for longer than the submit timeout
+    """
+
+
+class BoundedExecutor:
+    """
+    Thread pool with a bounded queue, callers submitting to a full queue wait for a free slot
+    """
+
+    def __init__(self, max_workers, max_queue, submit_timeout):
+        """
+        Init function of BoundedExecutor Class
+
+        :param max_workers: Number of worker threads
+        :type max_workers: int
+        :param max_queue: Number of tasks that can wait for a worker
+        :type max_queue: int
+        :param submit_timeout: Seconds to wait for a free slot before giving up
+        :type submit_timeout: float
+        """
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix="outbound")
+        self.slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self.submit_timeout = submit_timeout
+        self.closed = False
+
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Schedule fn(*args, **kwargs) to run on a worker thread
+
+        :param fn: Function to run
+        :type fn: callable
+        :return: Future of the result
+        :rtype: Future
+        :raises ExecutorFull: If no slot frees up within the submit timeout
+        """
+        return self._submit(self.slots.acquire(timeout=self.submit_timeout), fn, args, kwargs)
+
+    def try_submit(self, fn, *args, **kwargs):
+        """
+        Schedule fn(*args, **kwargs) to run on a worker thread without waiting for a free slot, for request threads
+
+        :param fn: Function to run
+        :type fn: callable
+        :return: Future of the result
+        :rtype: Future
+        :raises ExecutorFull: If the queue is full
+        """
+        return self._submit(self.slots.acquire(blocking=False), fn, args, kwargs)
+
+    def _submit(self, acquired, fn, args, kwargs):
+        """
+        Schedule a task once a slot has been asked for
+
+        :param acquired: Whether a slot was acquired
+        :type acquired: bool
+        :return: Future of the result
+        :rtype: Future
+        :raises ExecutorFull: If no slot was acquired
+        """
+        if not acquired:
+            with self.lock:
+                self.rejected += 1
+            raise ExecutorFull("Outbound queue is full")
+
+        with self.lock:
+            self.queued += 1
+        try:
+            return self.executor.submit(self._run, time.monotonic(), fn, args, kwargs)
+        except RuntimeError:
+            # Executor has been shut down
+            with self.lock:
+                self.queued -= 1
+            self.slots.release()
+            raise
+
+    def _run(self, submitted, fn, args, kwargs):
+        """
+        Run a task on the worker thread and record its metrics
+
+        :param submitted: Time the task was submitted
+        :type submitted: float
+        """
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+        try:
+            # Drop tasks still queued when shutting down
+            if not self.closed:
+                return fn(*args, **kwargs)
+        finally:
+            latency = time.monotonic() - submitted
+            with self.lock:
+                self.running -= 1
+                self.completed += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+            self.slots.release()
+
+    def metrics(self):
+        """
+        Return the queue depth and task latency of the executor
+
+        :return: Metrics of the executor
+        :rtype: dict
+        """
+        with self.lock:
+            if self.completed > 0:
+                average_latency = self.total_latency / self.completed
+            else:
+                average_latency = 0.0
+            return {
+                "Queue_Depth": self.queued,
+                "Running": self.running,
+                "Completed": self.completed,
+                "Rejected": self.rejected,
+                "Average_Latency": average_latency,
+                "Max_Latency": self.max_latency
+            }
+
+    def shutdown(self):
+        """
+        Stop accepting tasks, drop the queued ones and wait for the running ones to finish
+        """
+        self.closed = True
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,181 @@
+"""
+merkle.py
+=========
+Merkle tree over the block hashes of a case, hashed as in RFC 6962, with inclusion proofs
+
+The tree is stored as the MerkleNode of every complete subtree, the node at level L and position p covers the blocks
+p * 2^L to (p + 1) * 2^L - 1. The root of a case whose length is not a power of two is built from these on request.
+"""
+import hashlib
+
+
+def leaf_hash(block_hash):
+    """
+    Return the hash of a leaf of the tree
+
+    :param block_hash: Block hash of the block
+    :type block_hash: str
+    :return: Hash of the leaf, hex
+    :rtype: str
+    """
+    return hashlib.sha256(b"\x00" + block_hash.encode()).hexdigest()
+
+
+def node_hash(left, right):
+    """
+    Return the hash of a node of the tree from the hashes of its children
+
+    :param left: Hash of the left child, hex
+    :type left: str
+    :param right: Hash of the right child, hex
+    :type right: str
+    :return: Hash of the node, hex
+    :rtype: str
+    """
+    return hashlib.sha256(b"\x01" + bytes.fromhex(left) + bytes.fromhex(right)).hexdigest()
+
+
+def tree_nodes(leaves):
+    """
+    Return every complete subtree of a tree, used to build the tree of a case at once
+
+    :param leaves: Block hash of the blocks by block number
+    :type leaves: dict
+    :return: Hash of the nodes by level and position
+    :rtype: dict
+    """
+    nodes = {}
+    level = 0
+    level_nodes = {position: leaf_hash(block_hash) for (position, block_hash) in leaves.items()}
+    while level_nodes:
+        nodes.update(((level, position), node) for (position, node) in level_nodes.items())
+        level_nodes = {position >> 1: node_hash(node, level_nodes[position + 1])
+                       for (position, node) in level_nodes.items()
+                       if not position & 1 and position + 1 in level_nodes}
+        level += 1
+    return nodes
+
+
+def split(size):
+    """
+    Return the size of the left subtree of a tree, the largest power of two smaller than size
+
+    :param size: Number of leaves, at least 2
+    :type size: int
+    :return: Number of leaves in the left subtree
+    :rtype: int
+    """
+    return 1 << ((size - 1).bit_length() - 1)
+
+
+def subtree_keys(start, size):
+    """
+    Return the stored nodes the hash of a subtree is built from
+
+    :param start: First leaf of the subtree
+    :type start: int
+    :param size: Number of leaves of the subtree
+    :type size: int
+    :return: Level and position of the nodes
+    :rtype: list
+    """
+    if size & (size - 1) == 0:
+        level = size.bit_length() - 1
+        return [(level, start >> level)]
+    k = split(size)
+    return subtree_keys(start, k) + subtree_keys(start + k, size - k)
+
+
+def subtree_hash(nodes, start, size):
+    """
+    Return the hash of a subtree
+
+    :param nodes: Hash of the stored nodes by level and position, must contain subtree_keys(start, size)
+    :type nodes: dict
+    :param start: First leaf of the subtree
+    :type start: int
+    :param size: Number of leaves of the subtree
+    :type size: int
+    :return: Hash of the subtree, hex
+    :rtype: str
+    """
+    if size & (size - 1) == 0:
+        level = size.bit_length() - 1
+        return nodes[(level, start >> level)]
+    k = split(size)
+    return node_hash(subtree_hash(nodes, start, k), subtree_hash(nodes, start + k, size - k))
+
+
+def proof_subtrees(index, start, size):
+    """
+    Return the subtrees whose hashes make up the inclusion proof of a leaf, from the leaf up
+
+    :param index: Leaf to prove
+    :type index: int
+    :param start: First leaf of the tree
+    :type start: int
+    :param size: Number of leaves of the tree
+    :type size: int
+    :return: First leaf and size of the subtrees
+    :rtype: list
+    """
+    if size == 1:
+        return []
+    k = split(size)
+    if index < start + k:
+        return proof_subtrees(index, start, k) + [(start + k, size - k)]
+    return proof_subtrees(index, start + k, size - k) + [(start, k)]
+
+
+def proof_keys(index, size):
+    """
+    Return the stored nodes needed for the root and the inclusion proof of a leaf
+
+    :param index: Leaf to prove
+    :type index: int
+    :param size: Number of leaves of the tree
+    :type size: int
+    :return: Level and position of the nodes
+    :rtype: set
+    """
+    keys = set(subtree_keys(0, size))
+    for (start, length) in proof_subtrees(index, 0, size):
+        keys.update(subtree_keys(start, length))
+    return keys
+
+
+def verify_inclusion(block_hash, index, size, proof, root):
+    """
+    Check that a block is in a case, given an inclusion proof and the root of the case's tree (RFC 9162 2.1.3.2)
+
+    :param block_hash: Block hash of the block
+    :type block_hash: str
+    :param index: Block number of the block
+    :type index: int
+    :param size: Length of the case the proof was made for
+    :type size: int
+    :param proof: Hashes of the inclusion proof, from the leaf up
+    :type proof: list
+    :param root: Root of the tree of the case at that length
+    :type root: str
+    :return: Whether the proof holds
+    :rtype: bool
+    """
+    if index >= size:
+        return False
+    fn = index
+    sn = size - 1
+    result = leaf_hash(block_hash)
+    for sibling in proof:
+        if sn == 0:
+            return False
+        if fn & 1 or fn == sn:
+            result = node_hash(sibling, result)
+            while not fn & 1 and fn != 0:
+                fn >>= 1
+                sn >>= 1
+        else:
+            result = node_hash(result, sibling)
+        fn >>= 1
+        sn >>= 1
+    return sn == 0 and result == root
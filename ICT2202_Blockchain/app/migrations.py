@@ -0,0 +1,199 @@
+"""
+migrations.py
+=============
+Upgrades existing SQLite databases in place, since db.create_all() only creates missing tables
+"""
+import itertools
+from datetime import datetime
+
+from sqlalchemy import String, and_, cast, func, or_, select, text
+from sqlalchemy.dialects.sqlite import insert
+
+from app.models import Block, Peers, Pool, Consensus, UserCase, CaseHead, Checkpoint, FileIndex, MerkleNode, \
+    file_entry
+from app.merkle import tree_nodes
+
+
+def fill_case_heads(connection):
+    """
+    Fill the CaseHead table from the Block table for databases created before it existed
+
+    :param connection: Connection to the database
+    :type connection: Connection
+    """
+    connection.execute(text(
+        'INSERT OR IGNORE INTO "CaseHead" (case_id, length, last_hash, last_timestamp) '
+        'SELECT b.id, b.block_number + 1, b.block_hash, b.timestamp FROM "Block" b '
+        'JOIN (SELECT id, MAX(block_number) AS block_number FROM "Block" GROUP BY id) last '
+        'ON b.id = last.id AND b.block_number = last.block_number'
+    ))
+
+
+def create_indexes(connection, model, names):
+    """
+    Create the named indexes of a model that do not exist yet
+
+    :param connection: Connection to the database
+    :type connection: Connection
+    :param model: Model the indexes belong to
+    :type model: db.Model
+    :param names: Names of the indexes
+    :type names: list
+    """
+    for index in model.__table__.indexes:
+        if index.name in names:
+            index.create(connection, checkfirst=True)
+
+
+def add_indexes(connection):
+    """
+    Add the secondary indexes of Peers, Pool, Consensus and UserCase
+
+    Duplicated votes and user cases are removed first so the unique indexes can be built, keeping the latest vote.
+
+    :param connection: Connection to the database
+    :type connection: Connection
+    """
+    connection.execute(text(
+        'DELETE FROM "Consensus" WHERE consensus_id NOT IN '
+        '(SELECT MAX(consensus_id) FROM "Consensus" GROUP BY pool_id, ip_address)'
+    ))
+    connection.execute(text(
+        'DELETE FROM "UserCase" WHERE id NOT IN (SELECT MIN(id) FROM "UserCase" GROUP BY username, case_id)'
+    ))
+    create_indexes(connection, Peers, ["ix_peers_server_type"])
+    create_indexes(connection, Pool, ["ix_pool_case_id", "ix_pool_sendout_time"])
+    create_indexes(connection, Consensus, ["uq_consensus_pool_ip"])
+    create_indexes(connection, UserCase, ["uq_usercase_username_case_id"])
+
+
+def add_pool_segment(connection):
+    """
+    Add the segment_id column of Pool used by segment consensus
+
+    :param connection: Connection to the database
+    :type connection: Connection
+    """
+    columns = [row[1] for row in connection.execute(text('PRAGMA table_info("Pool")'))]
+    if "segment_id" not in columns:
+        connection.execute(text('ALTER TABLE "Pool" ADD COLUMN segment_id INTEGER'))
+    create_indexes(connection, Pool, ["ix_pool_segment_id"])
+
+
+def fill_file_index(connection):
+    """
+    Fill the FileIndex table from the meta data of the Block table for databases created before it existed
+
+    :param connection: Connection to the database
+    :type connection: Connection
+    """
+    rows = []
+    result = connection.execute(select(Block.id, Block.block_number, Block.meta_data))
+    for (case_id, block_number, meta_data) in result:
+        entry = file_entry(meta_data)
+        if entry is not None:
+            rows.append({"case_id": case_id, "block_number": block_number, "file_name": entry[0],
+                         "file_hash": entry[1]})
+    if rows:
+        connection.execute(insert(FileIndex.__table__).on_conflict_do_nothing(), rows)
+
+
+def fill_merkle_trees(connection):
+    """
+    Build the Merkle tree of every case from the Block table for databases created before it existed
+
+    :param connection: Connection to the database
+    :type connection: Connection
+    """
+    result = connection.execute(select(Block.id, Block.block_number, Block.block_hash)
+                                .order_by(Block.id, Block.block_number))
+    for (case_id, rows) in itertools.groupby(result, key=lambda row: row[0]):
+        nodes = tree_nodes({block_number: block_hash for (_, block_number, block_hash) in rows})
+        connection.execute(insert(MerkleNode.__table__).on_conflict_do_nothing(), [
+            {"case_id": case_id, "level": level, "position": position, "hash": node}
+            for ((level, position), node) in nodes.items()
+        ])
+
+
+# Every migration must be safe to run again on a database that already has the change
+MIGRATIONS = [
+    fill_case_heads,
+    add_indexes,
+    add_pool_segment,
+    fill_file_index,
+    fill_merkle_trees,
+]
+
+
+def upgrade(engine):
+    """
+    Run the migrations the database has not seen yet, tracking the version in SQLite's user_version
+
+    :param engine: Engine of the database
+    :type engine: Engine
+    """
+    with engine.begin() as connection:
+        version = connection.execute(text("PRAGMA user_version")).scalar()
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            migration(connection)
+            connection.execute(text("PRAGMA user_version = {}".format(number)))
+
+
+def hot_queries():
+    """
+    Queries run on every request or scheduled job, these must be served by an index
+
+    :return: List of queries
+    :rtype: list
+    """
+    return [
+        Peers.query.filter_by(server_type="client"),
+        Pool.query.filter_by(case_id=""),
+        Pool.query.filter(Pool.sendout_time <= datetime.now()),
+        Pool.query.filter_by(segment_id=0).order_by(Pool.block_number),
+        Pool.query.filter(Pool.id.in_(select(func.min(Pool.id)).group_by(Pool.case_id))),
+        Pool.query.with_entities(Pool.case_id, func.min(Pool.id)).filter(Pool.case_id.in_([""])).group_by(Pool.case_id),
+        Consensus.query.filter_by(pool_id="", ip_address=""),
+        Consensus.query.filter(Consensus.pool_id == "", Consensus.response == 1),
+        Pool.query.with_entities(Pool.id)
+            .join(Consensus, Consensus.pool_id == cast(Pool.id, String))
+            .filter(Pool.sendout_time >= datetime.now(), Consensus.response == 1)
+            .group_by(Consensus.pool_id)
+            .having(func.count(Consensus.consensus_id) >= 1)
+            .order_by(Pool.id),
+        UserCase.query.filter_by(username=""),
+        UserCase.query.filter_by(username="", case_id=""),
+        Block.query.filter(Block.id == "", Block.block_number >= 0).order_by(Block.block_number.asc()),
+        CaseHead.query.filter_by(case_id=""),
+        CaseHead.query.filter(CaseHead.case_id.in_([""])),
+        Checkpoint.query.filter_by(case_id=""),
+        FileIndex.query.filter_by(case_id="").order_by(FileIndex.block_number),
+        FileIndex.query.filter_by(file_hash="").order_by(FileIndex.case_id, FileIndex.block_number),
+        MerkleNode.query.filter_by(case_id="", level=0, position=0),
+        MerkleNode.query.filter(MerkleNode.case_id == "", or_(and_(MerkleNode.level == 0, MerkleNode.position == 0),
+                                                              and_(MerkleNode.level == 1, MerkleNode.position == 0))),
+    ]
+
+
+def check_query_plans(engine):
+    """
+    Return the hot queries that fall back to scanning a whole table
+
+    The plans depend on the SQLite version, so a scan is reported rather than raised, the queries still work.
+
+    :param engine: Engine of the database
+    :type engine: Engine
+    :return: Scan in the plan and SQL of every query that scans a table
+    :rtype: list
+    """
+    scans = []
+    with engine.connect() as connection:
+        for query in hot_queries():
+            compiled = query.statement.compile(dialect=engine.dialect, compile_kwargs={"render_postcompile": True})
+            params = tuple(compiled.params[name] for name in compiled.positiontup)
+            plan = connection.exec_driver_sql("EXPLAIN QUERY PLAN " + str(compiled), params).fetchall()
+            for row in plan:
+                detail = row[-1]
+                if detail.startswith("SCAN ") and " USING " not in detail:
+                    scans.append((detail, str(compiled)))
+    return scans
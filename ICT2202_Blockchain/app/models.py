@@ -4,10 +4,19 @@ models.py
 Database model for SQLite database
 """
 import hashlib
+import json
+import logging
 from dateutil import parser
 from datetime import datetime
 
+from sqlalchemy import event, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session, object_session
+
 from app import db
+from app.merkle import leaf_hash, node_hash
+
+logger = logging.getLogger(__name__)
 
 
 class Peers(db.Model):
@@ -15,7 +24,9 @@ class Peers(db.Model):
     Keeps database on who and how to communicate to other clients/nodes
     """
     __tablename__ = "Peers"
-    # __table_args__ = {'extend_existing': True}
+    __table_args__ = (
+        db.Index("ix_peers_server_type", "server_type"),
+    )
     id: int = db.Column(db.Integer, primary_key=True, autoincrement=True)
     ip_address = db.Column(db.String(15), nullable=False, unique=True)
     port = db.Column(db.SmallInteger, nullable=True)
@@ -139,13 +150,319 @@ class Block(db.Model):
         :return: block_number
         :rtype: str
         """
-        result = Block.query.filter_by(id=self.id).order_by(Block.block_number.desc()).first()
+        result = CaseHead.query.populate_existing().get(self.id)
         if result is None:
             self.block_number = 0
             self.previous_block_hash = str("")
         else:
-            self.block_number = result.block_number + 1
-            self.previous_block_hash = result.block_hash
+            self.block_number = result.length
+            self.previous_block_hash = result.last_hash
+
+
+class CaseHead(db.Model):
+    """
+    Keeps the length and last block of every case, updated together with every block inserted
+    """
+    __tablename__ = "CaseHead"
+    __table_args__ = {'extend_existing': True}
+
+    case_id = db.Column(db.String(255), primary_key=True)
+    length = db.Column(db.Integer, nullable=False)
+    last_hash = db.Column(db.String(255), nullable=False)
+    last_timestamp = db.Column(db.String(255), nullable=True)
+
+    def __init__(self, case_id, length, last_hash, last_timestamp):
+        """
+        Init function of CaseHead Class
+
+        :param case_id: Case ID of the case
+        :type case_id: str
+        :param length: Number of blocks in the case
+        :type length: int
+        :param last_hash: Block hash of the last block
+        :type last_hash: str
+        :param last_timestamp: Timestamp of the last block
+        :type last_timestamp: str
+        """
+        self.case_id = case_id
+        self.length = length
+        self.last_hash = last_hash
+        self.last_timestamp = last_timestamp
+
+    def as_dict(self):
+        """Returns this object as dict
+
+        Converts all keypair into a dict for outputing/processed as json object
+
+        :return: Object as dict
+        :rtype: dict
+        """
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+
+@event.listens_for(Block, "after_insert")
+def update_case_head(mapper, connection, target):
+    """
+    Move the CaseHead of the block's case forward in the same transaction that inserts the block
+
+    :param mapper: Mapper of Block
+    :param connection: Connection the block was inserted with
+    :param target: Block inserted
+    :type target: Block
+    """
+    table = CaseHead.__table__
+    statement = insert(table).values(case_id=target.id, length=target.block_number + 1,
+                                     last_hash=target.block_hash, last_timestamp=str(target.timestamp))
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.case_id],
+        set_={
+            "length": statement.excluded.length,
+            "last_hash": statement.excluded.last_hash,
+            "last_timestamp": statement.excluded.last_timestamp
+        },
+        where=table.c.length < statement.excluded.length
+    )
+    connection.execute(statement)
+
+
+class FileIndex(db.Model):
+    """
+    Keeps the file name and file hash of every block, filled in together with every block inserted
+    """
+    __tablename__ = "FileIndex"
+    __table_args__ = (
+        db.Index("ix_fileindex_file_hash", "file_hash"),
+        {'extend_existing': True}
+    )
+
+    case_id = db.Column(db.String(255), primary_key=True)
+    block_number = db.Column(db.Integer, primary_key=True)
+    file_name = db.Column(db.String(255), nullable=False)
+    file_hash = db.Column(db.String(255), nullable=False)
+
+    def __init__(self, case_id, block_number, file_name, file_hash):
+        """
+        Init function of FileIndex Class
+
+        :param case_id: Case ID of the case
+        :type case_id: str
+        :param block_number: Block number of the block
+        :type block_number: int
+        :param file_name: Name of the file in the block
+        :type file_name: str
+        :param file_hash: Hash of the file in the block
+        :type file_hash: str
+        """
+        self.case_id = case_id
+        self.block_number = block_number
+        self.file_name = file_name
+        self.file_hash = file_hash
+
+    def as_dict(self):
+        """Returns this object as dict
+
+        Converts all keypair into a dict for outputing/processed as json object
+
+        :return: Object as dict
+        :rtype: dict
+        """
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+
+def file_entry(meta_data):
+    """
+    Return the file name and file hash in the meta data of a block
+
+    :param meta_data: meta_data of the block
+    :type meta_data: str
+    :return: File name and file hash, None if the block has no file
+    :rtype: tuple
+    """
+    try:
+        meta_data = json.loads(meta_data)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(meta_data, dict) or not meta_data.get("File_Name"):
+        return None
+    return meta_data["File_Name"], meta_data.get("File_Hash", "")
+
+
+@event.listens_for(Block, "after_insert")
+def index_block_file(mapper, connection, target):
+    """
+    Add the file of the block to the FileIndex in the same transaction that inserts the block
+
+    :param mapper: Mapper of Block
+    :param connection: Connection the block was inserted with
+    :param target: Block inserted
+    :type target: Block
+    """
+    entry = file_entry(target.meta_data)
+    if entry is None:
+        return
+    statement = insert(FileIndex.__table__).values(case_id=target.id, block_number=target.block_number,
+                                                   file_name=entry[0], file_hash=entry[1])
+    connection.execute(statement.on_conflict_do_nothing())
+
+
+class MerkleNode(db.Model):
+    """
+    Keeps the complete subtrees of the Merkle tree over the block hashes of every case, see merkle.py
+    """
+    __tablename__ = "MerkleNode"
+    __table_args__ = {'extend_existing': True}
+
+    case_id = db.Column(db.String(255), primary_key=True)
+    level = db.Column(db.Integer, primary_key=True)
+    position = db.Column(db.Integer, primary_key=True)
+    hash = db.Column(db.String(64), nullable=False)
+
+    def __init__(self, case_id, level, position, hash):
+        """
+        Init function of MerkleNode Class
+
+        :param case_id: Case ID of the case
+        :type case_id: str
+        :param level: Height of the node, 0 for the leaves
+        :type level: int
+        :param position: Position of the node in its level
+        :type position: int
+        :param hash: Hash of the subtree
+        :type hash: str
+        """
+        self.case_id = case_id
+        self.level = level
+        self.position = position
+        self.hash = hash
+
+    def as_dict(self):
+        """Returns this object as dict
+
+        Converts all keypair into a dict for outputing/processed as json object
+
+        :return: Object as dict
+        :rtype: dict
+        """
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+
+def add_merkle_leaf(connection, case_id, block_number, block_hash):
+    """
+    Add a block to the Merkle tree of its case, along with every subtree it completes
+
+    A subtree is completed when both its halves are stored, so blocks may be added in any order.
+
+    :param connection: Connection to the database
+    :type connection: Connection
+    :param case_id: Case ID of the block
+    :type case_id: str
+    :param block_number: Block number of the block
+    :type block_number: int
+    :param block_hash: Block hash of the block
+    :type block_hash: str
+    """
+    table = MerkleNode.__table__
+    (level, position, node) = (0, block_number, leaf_hash(block_hash))
+    while True:
+        connection.execute(insert(table).values(case_id=case_id, level=level, position=position, hash=node)
+                           .on_conflict_do_nothing())
+        sibling = connection.execute(select(table.c.hash).where(
+            table.c.case_id == case_id, table.c.level == level, table.c.position == position ^ 1
+        )).scalar()
+        if sibling is None:
+            return
+        node = node_hash(sibling, node) if position & 1 else node_hash(node, sibling)
+        level += 1
+        position >>= 1
+
+
+@event.listens_for(Block, "after_insert")
+def update_merkle_tree(mapper, connection, target):
+    """
+    Add the block inserted to the Merkle tree of its case in the same transaction
+
+    :param mapper: Mapper of Block
+    :param connection: Connection the block was inserted with
+    :param target: Block inserted
+    :type target: Block
+    """
+    add_merkle_leaf(connection, target.id, target.block_number, target.block_hash)
+
+
+# Functions called once the changes recorded under a session.info key are committed
+commit_listeners = {"changed_cases": [], "changed_users": []}
+
+
+def on_block_commit(listener):
+    """
+    Register a function to be called with the set of case ID that have new blocks, after the blocks are committed
+
+    :param listener: Function taking a set of case ID
+    :type listener: callable
+    :return: The listener, so this can be used as a decorator
+    :rtype: callable
+    """
+    commit_listeners["changed_cases"].append(listener)
+    return listener
+
+
+def on_user_case_commit(listener):
+    """
+    Register a function to be called with the set of usernames assigned new cases, after the assignments are committed
+
+    :param listener: Function taking a set of usernames
+    :type listener: callable
+    :return: The listener, so this can be used as a decorator
+    :rtype: callable
+    """
+    commit_listeners["changed_users"].append(listener)
+    return listener
+
+
+@event.listens_for(Block, "after_insert")
+def record_changed_case(mapper, connection, target):
+    """
+    Remember the case of the block inserted until the session commits or rolls back
+
+    :param mapper: Mapper of Block
+    :param connection: Connection the block was inserted with
+    :param target: Block inserted
+    :type target: Block
+    """
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault("changed_cases", set()).add(target.id)
+
+
+@event.listens_for(Session, "after_commit")
+def notify_commit(session):
+    """
+    Call the commit listeners with the cases and users changed by the session, logging any that fail
+
+    :param session: Session committed
+    :type session: Session
+    """
+    for key, listeners in commit_listeners.items():
+        changed = session.info.pop(key, None)
+        if changed:
+            for listener in listeners:
+                # A failing listener must not keep the others from running or fail the commit
+                try:
+                    listener(changed)
+                except Exception:
+                    logger.exception("Commit listener %s failed", getattr(listener, "__qualname__", listener))
+
+
+@event.listens_for(Session, "after_rollback")
+def forget_changes(session):
+    """
+    Forget the cases and users changed by a session rolled back
+
+    :param session: Session rolled back
+    :type session: Session
+    """
+    for key in commit_listeners:
+        session.info.pop(key, None)
 
 
 class Pool(db.Model):
@@ -153,7 +470,12 @@ class Pool(db.Model):
     A temporary table that stores unverified blocks from all cases until they are verified. 
     """
     __tablename__ = "Pool"
-    __table_args__ = {'extend_existing': True}
+    __table_args__ = (
+        db.Index("ix_pool_case_id", "case_id", "id"),
+        db.Index("ix_pool_sendout_time", "sendout_time"),
+        db.Index("ix_pool_segment_id", "segment_id"),
+        {'extend_existing': True}
+    )
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     case_id = db.Column(db.String(255), nullable=True)
     block_number = db.Column(db.Integer, nullable=True)
@@ -165,8 +487,9 @@ class Pool(db.Model):
     status = db.Column(db.Boolean)
     count = db.Column(db.Integer, nullable=True)
     sendout_time = db.Column(db.DateTime, nullable=True)
+    segment_id = db.Column(db.Integer, nullable=True)
 
-    def __init__(self, case_id, meta_data, log):
+    def __init__(self, case_id, meta_data, log, block_number=None, previous_block_hash=None):
         """
         :param id: case number
         :type case_id: str
@@ -174,10 +497,18 @@ class Pool(db.Model):
         :type meta_data: str
         :param log: this refers to the action of user
         :type log: str
+        :param block_number: length of the case, looked up if not given
+        :type block_number: int
+        :param previous_block_hash: block hash of the last block of the case, looked up if not given
+        :type previous_block_hash: str
         """
 
         self.case_id = case_id
-        self.set_block_number()
+        if block_number is None:
+            self.set_block_number()
+        else:
+            self.block_number = block_number
+            self.previous_block_hash = previous_block_hash
 
         self.meta_data = meta_data
         self.log = log
@@ -190,6 +521,7 @@ class Pool(db.Model):
         self.status = False
         self.count = 0
         self.sendout_time = None
+        self.segment_id = None
 
     def __repr__(self):
         return "case_id: {}\nblock_number: {}\nprevious_block_hash: {}\nmeta_data: {}\nlog: " \
@@ -209,13 +541,13 @@ class Pool(db.Model):
         :return: block_number
         :rtype: str
         """
-        result = Block.query.filter_by(id=self.case_id).order_by(Block.block_number.desc()).first()
+        result = CaseHead.query.populate_existing().get(self.case_id)
         if result is None:
             self.block_number = 0
             self.previous_block_hash = str("")
         else:
-            self.block_number = result.block_number + 1
-            self.previous_block_hash = result.block_hash
+            self.block_number = result.length
+            self.previous_block_hash = result.last_hash
 
     def as_dict(self):
         """
@@ -234,7 +566,10 @@ class Consensus(db.Model):
     A temporary table that stores the consensus sent by selected clients to verify the blocks. 
     """
     __tablename__ = "Consensus"
-    __table_args__ = {'extend_existing': True}
+    __table_args__ = (
+        db.Index("uq_consensus_pool_ip", "pool_id", "ip_address", unique=True),  # One vote per peer per pool
+        {'extend_existing': True}
+    )
 
     consensus_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     ip_address = db.Column(db.String(15), nullable=False)
@@ -267,12 +602,52 @@ class Consensus(db.Model):
         return {c.name: getattr(self, c.name) for c in self.__table__.columns}
 
 
+class Checkpoint(db.Model):
+    """
+    Keeps track of the last verified block of every case so verification only re-hashes newer blocks
+    """
+    __tablename__ = "Checkpoint"
+    __table_args__ = {'extend_existing': True}
+
+    case_id = db.Column(db.String(255), primary_key=True)
+    block_number = db.Column(db.Integer, nullable=False)
+    block_hash = db.Column(db.String(255), nullable=False)
+
+    def __init__(self, case_id, block_number, block_hash):
+        """
+        Init function of Checkpoint Class
+
+        :param case_id: Case ID of the case
+        :type case_id: str
+        :param block_number: Block number of the last verified block
+        :type block_number: int
+        :param block_hash: Block hash of the last verified block
+        :type block_hash: str
+        """
+        self.case_id = case_id
+        self.block_number = block_number
+        self.block_hash = block_hash
+
+    def as_dict(self):
+        """Returns this object as dict
+
+        Converts all keypair into a dict for outputing/processed as json object
+
+        :return: Object as dict
+        :rtype: dict
+        """
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+
 class UserCase(db.Model):
     """
     Keeps track on the User's assigned cases in the blockchain
     """
     __tablename__ = "UserCase"
-    __table_args__ = {'extend_existing': True}
+    __table_args__ = (
+        db.Index("uq_usercase_username_case_id", "username", "case_id", unique=True),
+        {'extend_existing': True}
+    )
 
     id: int = db.Column(db.Integer, primary_key=True, autoincrement=True)
     username = db.Column(db.String(255), nullable=False)
@@ -298,4 +673,19 @@ class UserCase(db.Model):
         :return: Object as dict
         :rtype: dict
         """
-        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
\ No newline at end of file
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+
+@event.listens_for(UserCase, "after_insert")
+def record_changed_user(mapper, connection, target):
+    """
+    Remember the user assigned a case until the session commits or rolls back
+
+    :param mapper: Mapper of UserCase
+    :param connection: Connection the row was inserted with
+    :param target: UserCase inserted
+    :type target: UserCase
+    """
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault("changed_users", set()).add(target.username)
@@ -0,0 +1,164 @@
+"""
+search.py
+=========
+Full-text index of the log and meta data of every block, using SQLite's FTS5
+"""
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError
+
+from app.models import Block
+
+
+class SearchIndex:
+    """
+    Keeps the BlockSearch FTS5 table in step with the Block table, so custody logs can be searched without parsing
+    every block
+
+    An indexed block is found by its case and block number, the primary key of the Block table, since the rowid of a
+    block can change when the database is vacuumed. The case, block number and timestamp are stored but not indexed,
+    they are only used to find, filter and return the results. If SQLite is built without FTS5 the index is disabled
+    and blocks are added as usual.
+    """
+
+    def __init__(self, enabled):
+        """
+        Init function of SearchIndex Class
+
+        :param enabled: Whether to keep the index, if SQLite supports it
+        :type enabled: bool
+        """
+        self.wanted = enabled
+        self.enabled = False
+        event.listen(Block, "after_insert", self.index_block)
+
+    def create(self, engine):
+        """
+        Create the BlockSearch table if it does not exist yet
+
+        :param engine: Engine of the database
+        :type engine: Engine
+        :return: Whether the index is enabled
+        :rtype: bool
+        """
+        if not self.wanted or engine.dialect.name != "sqlite":
+            return False
+        try:
+            with engine.begin() as connection:
+                connection.execute(text(
+                    'CREATE VIRTUAL TABLE IF NOT EXISTS "BlockSearch" USING fts5('
+                    'case_id UNINDEXED, block_number UNINDEXED, timestamp UNINDEXED, log, meta_data)'
+                ))
+        except OperationalError:
+            # SQLite built without FTS5
+            return False
+        self.enabled = True
+        return True
+
+    def index_block(self, mapper, connection, target):
+        """
+        Add the block inserted to the index in the same transaction
+
+        :param mapper: Mapper of Block
+        :param connection: Connection the block was inserted with
+        :param target: Block inserted
+        :type target: Block
+        """
+        if not self.enabled:
+            return
+        connection.execute(text(
+            'INSERT INTO "BlockSearch" (case_id, block_number, timestamp, log, meta_data) '
+            'SELECT id, block_number, timestamp, log, meta_data FROM "Block" '
+            'WHERE id = :case_id AND block_number = :block_number'
+        ), {"case_id": target.id, "block_number": target.block_number})
+
+    def search(self, session, query, case_id=None, start=None, end=None, limit=100):
+        """
+        Return the blocks matching a full-text query, best match first
+
+        :param session: Session to read with
+        :type session: Session
+        :param query: FTS5 query, e.g. AddUser, "TestUser" AND Upload
+        :type query: str
+        :param case_id: Only return blocks of this case
+        :type case_id: str
+        :param start: Only return blocks with a timestamp from this time, e.g. 2021-10-01
+        :type start: str
+        :param end: Only return blocks with a timestamp before this time, e.g. 2021-11-01
+        :type end: str
+        :param limit: Maximum number of blocks returned
+        :type limit: int
+        :return: Matching blocks with their bm25 score, lower is better
+        :rtype: list
+        :raises OperationalError: If the query is not valid FTS5 syntax
+        """
+        conditions = ['"BlockSearch" MATCH :query']
+        params = {"query": query, "limit": limit}
+        if case_id is not None:
+            conditions.append("case_id = :case_id")
+            params["case_id"] = case_id
+        if start is not None:
+            conditions.append("timestamp >= :start")
+            params["start"] = start
+        if end is not None:
+            conditions.append("timestamp < :end")
+            params["end"] = end
+
+        result = session.execute(text(
+            'SELECT case_id, block_number, timestamp, log, meta_data, rank FROM "BlockSearch" '
+            'WHERE ' + " AND ".join(conditions) + ' ORDER BY rank LIMIT :limit'
+        ), params)
+        return [{
+            "case_id": row.case_id,
+            "block_number": row.block_number,
+            "timestamp": row.timestamp,
+            "log": row.log,
+            "meta_data": row.meta_data,
+            "score": row.rank
+        } for row in result]
+
+    def backfill(self, engine, writer, batch_size):
+        """
+        Index the blocks that are not in the index yet, streaming them in batches through the writer
+
+        The blocks and the index are read by one query, so blocks inserted while it runs are not read and are indexed
+        by index_block instead. This is safe to run on a live node and to run again, but not twice at once.
+
+        :param engine: Engine to read the blocks with
+        :type engine: Engine
+        :param writer: Writer to index the blocks with
+        :type writer: DatabaseWriter
+        :param batch_size: Number of blocks indexed in one transaction
+        :type batch_size: int
+        :return: Number of blocks indexed
+        :rtype: int
+        """
+        if not self.enabled:
+            return 0
+        indexed = 0
+        with engine.connect() as connection:
+            result = connection.execution_options(stream_results=True).execute(text(
+                'SELECT id AS case_id, block_number, timestamp, log, meta_data FROM "Block" '
+                'WHERE (id, block_number) NOT IN (SELECT case_id, block_number FROM "BlockSearch") '
+                'ORDER BY id, block_number'
+            ))
+            for partition in result.partitions(batch_size):
+                indexed += writer.call(index_rows, [dict(row._mapping) for row in partition])
+        return indexed
+
+
+def index_rows(session, row_list):
+    """
+    Add blocks to the index
+
+    :param session: Session of the writer
+    :type session: Session
+    :param row_list: case_id, block_number, timestamp, log and meta_data of the blocks
+    :type row_list: list
+    :return: Number of blocks indexed
+    :rtype: int
+    """
+    session.execute(text(
+        'INSERT INTO "BlockSearch" (case_id, block_number, timestamp, log, meta_data) '
+        'VALUES (:case_id, :block_number, :timestamp, :log, :meta_data)'
+    ), row_list)
+    return len(row_list)
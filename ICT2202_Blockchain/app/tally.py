@@ -0,0 +1,53 @@
+"""
+tally.py
+========
+In-memory count of the positive votes of unverified blocks
+"""
+import threading
+
+
+class VoteTally:
+    """
+    Keeps which delegates voted yes on every unverified block, so a block can be added as soon as it has enough votes
+
+    Only votes received since startup are known, the scheduled check_twothird still counts the votes in the database.
+    """
+
+    def __init__(self):
+        """
+        Init function of VoteTally Class
+        """
+        self.lock = threading.Lock()
+        self.votes = {}
+
+    def add(self, pool_id, ip_address, response):
+        """
+        Record the vote of a delegate, replacing its previous vote
+
+        :param pool_id: ID of the unverified block
+        :type pool_id: int
+        :param ip_address: ip address of the delegate
+        :type ip_address: str
+        :param response: Whether the delegate verified the block
+        :type response: bool
+        :return: Number of positive votes of the block
+        :rtype: int
+        """
+        with self.lock:
+            voters = self.votes.setdefault(pool_id, set())
+            if response:
+                voters.add(ip_address)
+            else:
+                voters.discard(ip_address)
+            return len(voters)
+
+    def discard(self, pool_id_list):
+        """
+        Forget the votes of blocks that have been added, rehashed or removed
+
+        :param pool_id_list: ID of the unverified blocks
+        :type pool_id_list: list
+        """
+        with self.lock:
+            for pool_id in pool_id_list:
+                self.votes.pop(pool_id, None)
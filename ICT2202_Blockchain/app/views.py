@@ -4,16 +4,27 @@ views.py
 The webpage routing of flask server
 """
 import datetime
-import sys
 import json
+import sys
 from flask import request, jsonify
 
-from app import app, db, auth
-from app.controller import convert_to_pool, convert_to_consensus, verify, send_new_verified_to_clients
-from app.models import Block, Pool, Consensus, UserCase
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+
+from app import app, auth, executor, peer_registry, wire_formats, writer, search_index, read_engine, ReadSession, \
+    state_digest
+from app.cache import ResponseCache
+from app.digest import BUCKETS
+from app.controller import convert_to_consensus, verify, verify_cases, get_inclusion_proof, send_new_verified_to_clients, record_votes, pool_deadlines, \
+    add_received_blocks
+from app.models import Peers, Block, UserCase, CaseHead, FileIndex, on_block_commit, on_user_case_commit
 
 STATUS_OK = 200
+STATUS_NOT_MODIFIED = 304
+STATUS_BAD_REQUEST = 400
 STATUS_NOT_FOUND = 404
+# Case ID sent in one query when reading the case heads of some buckets
+CASE_HEAD_BATCH = 500
 TIMEOUT = 60 * 15
 
 tokens = {
@@ -22,6 +33,26 @@ tokens = {
 }
 
 
+def record_inbound():
+    """
+    Any authenticated request received from a peer in the peer list shows that it is alive, other addresses are not
+    recorded so they cannot fill the registry or pass for a peer
+    """
+    if ReadSession.query(Peers.id).filter_by(ip_address=request.remote_addr).first() is None:
+        return
+    peer_registry.record_success(request.remote_addr)
+    wire_formats.learn(request.remote_addr, request.headers)
+
+
+@app.after_request
+def advertise_formats(response):
+    """
+    Tell the requester which formats it can send data to this machine in
+    """
+    response.headers.update(wire_formats.header())
+    return response
+
+
 @app.route("/health")
 def current_health():
     """
@@ -38,6 +69,20 @@ def current_health():
     return resp, STATUS_OK
 
 
+@app.route("/metrics")
+@auth.login_required
+def metrics():
+    """
+    Return metrics of the outbound worker pool, the database writer and known peers
+
+    :return: Queue depth and task latency of the outbound workers and the writer, status of the peers
+    :rtype:
+        - dict
+        - Status 200
+    """
+    return {"Executor": executor.metrics(), "Writer": writer.metrics(), "Peers": peer_registry.metrics()}, STATUS_OK
+
+
 # Assuming unverified
 @app.route('/receiveblock', methods=['POST'])
 @auth.login_required
@@ -45,83 +90,79 @@ def receive_block():
     """
     Server to receive blocks from server
 
-    :return: Show input receives by server
+    The whole batch is added in one transaction, every entry is hashed against the last block of its case as it was
+    at the start of the batch, or against the block 0 created earlier in the batch.
+
+    :return: Show input receives by server, with the result of every entry
     :rtype: json, Status 200
     """
-    num_of_errors = 0
-
     # Check block need verify
     json_blocks = request.get_json()
-    for json_block in json_blocks["Pool"]:
-
-        # Convert into class object
-        block = convert_to_pool(json_block)
-        if block is None:
-            ("Error processing: {}".format(json_block))
-            num_of_errors += 1
-            continue
-
-        # If case doesnt exist (Block 0) add to block directly
-        exist = Block.query.filter_by(id=block.case_id).first()
-        if exist is None:
-            # Add to Block
-            new_block = Block(block.case_id, block.meta_data, block.log, block_number=block.block_number,
-                              previous_block_hash=block.previous_block_hash, timestamp=block.timestamp,
-                              block_hash=block.block_hash, status=1)
-            db.session.add(new_block)
-            db.session.commit()
-
-            # Sending new verified blocks to clients
-            send_new_verified_to_clients(new_block)
-        else:
-            # Add to Pool
-            db.session.add(block)
-            db.session.commit()
+    (results, new_block_list, new_pool_list) = writer.call(add_received_blocks, json_blocks["Pool"])
+    num_of_errors = len([result for result in results if result["Status"] == "Error"])
+
+    now = datetime.datetime.now()
+    for block in new_pool_list:
+        pool_deadlines.schedule(block.id, now)
+
+    # Sending new verified blocks to clients, once for the whole batch
+    if new_block_list:
+        send_new_verified_to_clients(new_block_list)
 
     # Print extra info
-    json_blocks.update({"Errors": num_of_errors})
+    json_blocks.update({"Errors": num_of_errors, "Results": results})
     return json_blocks, STATUS_OK
 
 
 @app.route('/receive_response', methods=['POST'])
 @auth.login_required
 def receive_response():
-    # Placeholder Expected Input: {"pool_id": "2", "response": "yes"}
-    # Process Json to Consensus Model Object\
+    # Expected Input: {"pool_id": "2", "response": 1} or {"Votes": [{"pool_id": "2", "response": 1}, ...]}
     """
-    This function will receive the response sent by the delegates (client) 
+    This function will receive the responses sent by the delegates (client), either a single vote or a batch of votes
 
-    :return: Give a response whether the code runs smoothly 
+    :return: Give a response whether the code runs smoothly
     :rtype:
         - Success - dictionary, 200
         - Failure - str, "Error Occurred"
     """
     resp = request.get_json()
-    consensus = convert_to_consensus(resp, request.remote_addr)
-    if consensus is None:
+    if resp is None:
         return "Error Occurred!"
 
-    # Check Timeout
-    pool = Pool.query.filter_by(id=consensus.pool_id).first()
-    if pool is not None:
-        response_timestamp = pool.sendout_time
-        try:
-            if (response_timestamp + datetime.timedelta(seconds=TIMEOUT)) >= datetime.datetime.now():
-                # Add to consensus Table
-                consent = Consensus.query.filter_by(ip_address=consensus.ip_address, pool_id=consensus.pool_id).first()
-                if consent is None:
-                    db.session.add(consensus)
-                    db.session.commit()
-                else:
-                    consent.response = consensus.response
-                    consent.receive_timestamp = consensus.receive_timestamp
-                    db.session.commit()
-            else:
-                # Discard (TIMED OUT)
-                pass
-        except:
-            pass
-    return {"Responding From": "/receive_response"}, STATUS_OK
+    if "Votes" in resp:
+        vote_list = resp["Votes"]
+    else:
+        if convert_to_consensus(resp, request.remote_addr) is None:
+            return "Error Occurred!"
+        vote_list = [resp]
+
+    # Votes for timed out blocks are discarded
+    number_of_votes = record_votes(vote_list, request.remote_addr, datetime.timedelta(seconds=TIMEOUT))
+    return {"Responding From": "/receive_response", "Votes": number_of_votes}, STATUS_OK
+
+
+@app.route('/digest')
+@auth.login_required
+def digest():
+    """
+    Return the digest of every case head and of every bucket of cases, so peers only ask for the case heads that differ
+
+    The digest is the ETag of the response, a peer sending its own digest as If-None-Match gets 304 Not Modified when
+    both hold the same case heads.
+
+    :return: Digest and digests by bucket
+    :rtype:
+        - Same case heads - empty, 304
+        - Otherwise - dictionary, 200
+    """
+    (state, bucket_digests) = state_digest.snapshot()
+    if request.if_none_match.contains(state):
+        response = app.response_class(status=STATUS_NOT_MODIFIED)
+    else:
+        response = wire_formats.respond({"digest": state, "Buckets": bucket_digests})
+    response.set_etag(state)
+    return response
 
 
 @app.route('/sync')
@@ -130,19 +171,30 @@ def sync():
     """
     Return the length of blockchain for syncing
 
+    Takes an optional buckets query string, e.g. buckets=3,17, to only return the cases in those buckets of /digest.
+
     :return: Case ID's length and last_hash
     :rtype: json
     """
+    if request.args.get("buckets") is None:
+        case_head_list = ReadSession.query(CaseHead).all()
+    else:
+        try:
+            bucket_list = [int(bucket) for bucket in request.args["buckets"].split(",") if bucket]
+        except ValueError:
+            return "fail, buckets must be numbers", STATUS_BAD_REQUEST
+        if any(bucket < 0 or bucket >= BUCKETS for bucket in bucket_list):
+            return "fail, buckets must be from 0 to {}".format(BUCKETS - 1), STATUS_BAD_REQUEST
+        case_id_list = state_digest.cases_in(bucket_list)
+        case_head_list = []
+        for start in range(0, len(case_id_list), CASE_HEAD_BATCH):
+            case_head_list += ReadSession.query(CaseHead) \
+                .filter(CaseHead.case_id.in_(case_id_list[start:start + CASE_HEAD_BATCH])).all()
+
     output = []
-    id_list = Block.query.with_entities(Block.id).distinct()
-    for case_id in id_list:
-        case_id = case_id[0]  # IDK why
-        length = Block.query.filter_by(id=case_id).count()  # Get length of ID
-        last_hash = Block.query.filter_by(id=case_id) \
-            .order_by(Block.block_number.desc()) \
-            .first()
-        output.append({"id": case_id, "length": length, "last": last_hash.block_hash})
-    return jsonify(Blocks=output)
+    for case_head in case_head_list:
+        output.append({"id": case_head.case_id, "length": case_head.length, "last": case_head.last_hash})
+    return wire_formats.respond({"Blocks": output})
 
 
 # Syncing blockchain, request length of id, if longer send all blocks above length (Honestly cutting corners here)
@@ -152,6 +204,10 @@ def sync_receive():
     """
     Send missing blocks back to the machine requesting it
 
+    With limit, the blocks are sent oldest first in pages of at most limit blocks, next is the length to ask for to get
+    the following page, None on the last page. With stream, every block is streamed oldest first as a line of NDJSON.
+    Without either, every block is sent newest first in one response.
+
     :return: Blocks missing, Length of Blockchain and Number of blocks sending
     :rtype: json
     """
@@ -163,33 +219,81 @@ def sync_receive():
     resp_id = resp["id"]
     resp_length = resp["length"]
     resp_last = resp["last"] == 1
+    table = Block.__table__
+    blocks_above = select(table).where(table.c.id == resp_id, table.c.block_number >= resp_length)
+
+    if resp.get("stream"):
+        return app.response_class(stream_blocks(blocks_above.order_by(table.c.block_number.asc()), resp_last),
+                                  mimetype="application/x-ndjson")
+
+    if resp.get("limit") is not None:
+        try:
+            limit = min(int(resp["limit"]), app.config["SYNC_MAX_PAGE_SIZE"])
+        except (TypeError, ValueError):
+            return "", STATUS_NOT_FOUND
+        if limit < 1:
+            return "", STATUS_NOT_FOUND
+        case_head = ReadSession.query(CaseHead).filter_by(case_id=resp_id).first()
+        length = case_head.length if case_head is not None else 0
+
+        # One more block than asked for tells whether there is another page
+        rows = ReadSession.execute(blocks_above.order_by(table.c.block_number.asc()).limit(limit + 1)).all()
+        next_length = rows[limit].block_number if len(rows) > limit else None
+        output_list = [sync_data(row, resp_last) for row in rows[:limit]]
+        return wire_formats.respond({"Blocks": output_list, "length": length, "Count": len(output_list),
+                                     "next": next_length})
+
     output_list = []
     block_list_count = 0
-    length = Block.query.filter_by(id=resp_id).count()  # Get length of ID
+    length = ReadSession.query(Block).filter_by(id=resp_id).count()  # Get length of ID
 
     # If length is longer then sender, send blocks
     if length > resp_length:
-        if resp_last:
-            # Get send previous hash also (For Client)
-            block_list = Block.query.filter(Block.id == resp_id, Block.block_number >= resp_length).order_by(
-                Block.block_number.desc()).all()
-            for block in block_list:
-                data = {
-                    "id": block.id,
-                    "previous_hash": block.previous_block_hash,
-                    "hash": block.block_hash,
-                    "block_number": block.block_number
-                }
-                output_list.append(data)
-        else:
-            # Get all blocks above length (For Nodes)
-            block_list = Block.query.filter(Block.id == resp_id, Block.block_number >= resp_length) \
-                .order_by(Block.block_number.desc())
-            block_list_count = Block.query.filter(Block.block_number >= resp_length).count()  # For printing only
-            for block in block_list:
-                data = block.as_dict()
-                output_list.append(data)
-    return jsonify({"Blocks": output_list, "length": length, "Count": block_list_count})
+        rows = ReadSession.execute(blocks_above.order_by(table.c.block_number.desc())).all()
+        output_list = [sync_data(row, resp_last) for row in rows]
+        if not resp_last:
+            # For printing only
+            block_list_count = ReadSession.query(Block).filter(Block.block_number >= resp_length).count()
+    return wire_formats.respond({"Blocks": output_list, "length": length, "Count": block_list_count})
+
+
+def sync_data(row, for_client):
+    """
+    Return a row of Block as sent by /sync
+
+    :param row: Row of the Block table
+    :type row: Row
+    :param for_client: Whether to send only the hashes, for clients, or the whole block, for nodes
+    :type for_client: bool
+    :return: Block as dict
+    :rtype: dict
+    """
+    if for_client:
+        # Get send previous hash also (For Client)
+        return {
+            "id": row.id,
+            "previous_hash": row.previous_block_hash,
+            "hash": row.block_hash,
+            "block_number": row.block_number
+        }
+    return dict(row._mapping)
+
+
+def stream_blocks(statement, for_client):
+    """
+    Yield the blocks selected as lines of NDJSON, reading them from the database a page at a time
+
+    :param statement: Select of the blocks
+    :type statement: Select
+    :param for_client: Whether to send only the hashes, for clients, or the whole block, for nodes
+    :type for_client: bool
+    :return: Lines of NDJSON
+    :rtype: generator
+    """
+    with read_engine.connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(statement)
+        for partition in result.partitions(app.config["SYNC_PAGE_SIZE"]):
+            yield "".join(json.dumps(sync_data(row, for_client)) + "\n" for row in partition)
 
 
 # Getting Data From Database
@@ -204,25 +308,21 @@ def get_peers():
         - Success - list, 200
         - Failure - str, 200
     """
-    case_list = set()
-
     post_data = request.get_json()
     if "Username" not in post_data:
         return "", STATUS_OK
 
-    username = post_data["Username"]
+    username = str(post_data["Username"])
     # Get all cases with username
-    usercase_list = UserCase.query.filter_by(username=str(username)).all()
+    usercase_list = user_cases(username)
     if len(usercase_list) > 0:
-        for case in usercase_list:
-            case_id = case.case_id
-
-            # Double check case_id blockchain is verified
-            if verify(case_id):
-                case_list.add(case_id)
-            else:
-                return "Blockchain Verification Failed", STATUS_OK
-        return jsonify({"Cases": sorted(list(case_list))}), STATUS_OK
+        case_list = sorted({case["case_id"] for case in usercase_list})
+
+        # Double check case_id blockchain is verified
+        if verify_cases(case_list):
+            return jsonify({"Cases": case_list}), STATUS_OK
+        else:
+            return "Blockchain Verification Failed", STATUS_OK
     else:
         # No Cases Found
         return "", STATUS_OK
@@ -240,6 +340,7 @@ def verify_token(token):
         - Success - str, username
     """
     if token in tokens:
+        record_inbound()
         return tokens[token]
 
 
@@ -259,14 +360,86 @@ def assignedCase():
     username = request.json.get('username')
     if username is None:
         return "failed, username is None"
-    query = UserCase.query.filter_by(username=username).all()
-    query = [x.as_dict() for x in query]
+    query = user_cases(username)
     if query:
         return jsonify(query)
     return "fail"
 
 
-@app.route('/caseinfo', methods=['POST'])
+response_cache = ResponseCache(app.config["RESPONSE_CACHE_SIZE"])
+on_block_commit(response_cache.invalidate)
+user_case_cache = ResponseCache(app.config["USER_CASE_CACHE_SIZE"])
+on_user_case_commit(user_case_cache.invalidate)
+
+
+def user_cases(username):
+    """
+    Return the cases assigned to a user, from the cache until the user is assigned another case
+
+    :param username: Username of the User
+    :type username: str
+    :return: Rows of UserCase as dict
+    :rtype: list
+    """
+    rows = user_case_cache.get(("usercase", username), None)
+    if rows is None:
+        generation = user_case_cache.generation
+        rows = [x.as_dict() for x in ReadSession.query(UserCase).filter_by(username=username).all()]
+        user_case_cache.put(("usercase", username), None, rows, generation)
+    return rows
+
+
+def get_case_id():
+    """
+    Return the case_id of a query, from the query string for GET or the json body for POST
+
+    :return: case_id
+    :rtype: str
+    """
+    if request.method == "GET":
+        return request.args.get('case_id')
+    return request.json.get('case_id')
+
+
+def case_response(endpoint, case_id, build):
+    """
+    Answer a query on a case from the response cache, or with 304 Not Modified if the caller has the latest version
+
+    The version of a case is the hash of its last block, sent as the ETag of the response and matched against
+    If-None-Match.
+
+    :param endpoint: Name of the endpoint
+    :type endpoint: str
+    :param case_id: case_id of the query
+    :type case_id: str
+    :param build: Function returning the body of the response and the hash of the last block it was built from, or an
+        error response and None
+    :type build: callable
+    :return: Response
+    :rtype: Response
+    """
+    case_head = ReadSession.query(CaseHead).filter_by(case_id=case_id).first()
+    if case_head is not None:
+        if request.if_none_match.contains(case_head.last_hash):
+            response = app.response_class(status=STATUS_NOT_MODIFIED)
+            response.set_etag(case_head.last_hash)
+            return response
+        body = response_cache.get((endpoint, case_id), case_head.last_hash)
+        if body is not None:
+            response = jsonify(body)
+            response.set_etag(case_head.last_hash)
+            return response
+
+    (body, last_hash) = build(case_id)
+    if last_hash is None:
+        return body
+    response_cache.put((endpoint, case_id), last_hash, body)
+    response = jsonify(body)
+    response.set_etag(last_hash)
+    return response
+
+
+@app.route('/caseinfo', methods=['GET', 'POST'])
 @auth.login_required
 def caseinfo():
     """
@@ -275,22 +448,33 @@ def caseinfo():
     :return: dictionary of rows of block
     :rtype:
         - Success - dictionary, 200
+        - Not Modified - 304, if If-None-Match has the ETag of the case
         - Failure - str
     """
     # For testing: curl -i -X POST -H "Content-Type:application/json" -H "Authorization:Bearer secret-token-1" http://{your ip }:5000/caseinfo -d {\"case_id\":\"1\"}
-    case_id = request.json.get('case_id')
-    sql = Block.query.filter_by(id=case_id).all()
-    sql = [x.as_dict() for x in sql]
+    return case_response("caseinfo", get_case_id(), build_caseinfo)
+
+
+def build_caseinfo(case_id):
+    """
+    Build the /caseinfo response of a case
+
+    :param case_id: case_id of the query
+    :type case_id: str
+    :return: Body of the response and the hash of the last block, or an error and None
+    :rtype: tuple
+    """
+    sql = ReadSession.query(Block).filter_by(id=case_id).order_by(Block.block_number).all()
     if sql:
         if verify(case_id):
-            return jsonify(Blocks=sql)
+            return {"Blocks": [x.as_dict() for x in sql]}, sql[-1].block_hash
         else:
-            return "Blockchain Verification Failed"
+            return "Blockchain Verification Failed", None
     else:
-        return "fail, cannot find case_id"
+        return "fail, cannot find case_id", None
 
 
-@app.route('/filenameAndHash', methods=['POST'])
+@app.route('/filenameAndHash', methods=['GET', 'POST'])
 @auth.login_required
 def filenameAndHash():
     """
@@ -299,20 +483,117 @@ def filenameAndHash():
     :return: dictionary of rows of block
     :rtype:
         - Success - dictionary, 200
+        - Not Modified - 304, if If-None-Match has the ETag of the case
         - Failure - str, "fail"
     """
-    case_id = request.json.get('case_id')
-    sql = Block.query.filter_by(id=case_id).all()
-    sql = [x.as_dict() for x in sql]
-    if sql:
-        if not verify(case_id):
-            return "Blockchain Verification Failed"
-        output = set()
-        for i in sql:
-            i = json.loads(i["meta_data"])
-            if i["File_Name"] != "":
-                output.add('{"File_Name":' + '"' + i["File_Name"] + '"' + ',"File_Hash":' + '"' + i["File_Hash"] + '"' + '}')
-            return_data = [json.loads(x) for x in list(output)]
-        return jsonify(Files=return_data)
+    return case_response("filenameAndHash", get_case_id(), build_filename_and_hash)
+
+
+def build_filename_and_hash(case_id):
+    """
+    Build the /filenameAndHash response of a case
+
+    :param case_id: case_id of the query
+    :type case_id: str
+    :return: Body of the response and the hash of the last block, or an error and None
+    :rtype: tuple
+    """
+    case_head = ReadSession.query(CaseHead).filter_by(case_id=case_id).first()
+    if case_head is None:
+        return "fail", None
+    if not verify(case_id):
+        return "Blockchain Verification Failed", None
+
+    files = ReadSession.query(FileIndex).filter_by(case_id=case_id).order_by(FileIndex.block_number).all()
+    output = {}
+    for file in files:
+        output.setdefault((file.file_name, file.file_hash), {"File_Name": file.file_name, "File_Hash": file.file_hash})
+    return {"Files": list(output.values())}, case_head.last_hash
+
+
+@app.route('/filehash', methods=['GET', 'POST'])
+@auth.login_required
+def filehash():
+    """
+    Return the cases and blocks that contain a file, looked up by file hash
+
+    :return: dictionary of rows of FileIndex
+    :rtype:
+        - Success - dictionary, 200
+        - Failure - str, "fail"
+    """
+    # For testing: curl -X POST -H "Content-Type:application/json" -H "Authorization:Bearer secret-token-1" http://{your ip }:5000/filehash -d {\"file_hash\":\"...\"}
+    if request.method == "GET":
+        file_hash = request.args.get('file_hash')
     else:
+        file_hash = request.json.get('file_hash')
+    if not file_hash:
         return "fail"
+
+    files = ReadSession.query(FileIndex).filter_by(file_hash=file_hash) \
+        .order_by(FileIndex.case_id, FileIndex.block_number).all()
+    return jsonify({"Files": [x.as_dict() for x in files]})
+
+
+@app.route('/search', methods=['GET', 'POST'])
+@auth.login_required
+def search():
+    """
+    Return the blocks whose log or meta data match a full-text query, best match first
+
+    Takes query, and optionally case_id, from and to (timestamps, from inclusive and to exclusive) and limit, from the
+    query string for GET or the json body for POST.
+
+    :return: dictionary of matching blocks
+    :rtype:
+        - Success - dictionary, 200
+        - Failure - str, 400 if the query is not valid, 404 if search is not available
+    """
+    # For testing: curl -X POST -H "Content-Type:application/json" -H "Authorization:Bearer secret-token-1" http://{your ip }:5000/search -d {\"query\":\"AddUser\"}
+    if not search_index.enabled:
+        return "Search is not available", STATUS_NOT_FOUND
+    args = request.args if request.method == "GET" else request.json
+    query = args.get('query')
+    if not query:
+        return "fail, query is required", STATUS_BAD_REQUEST
+    try:
+        limit = min(int(args.get('limit', app.config["SEARCH_MAX_RESULTS"])), app.config["SEARCH_MAX_RESULTS"])
+    except (TypeError, ValueError):
+        return "fail, limit must be a number", STATUS_BAD_REQUEST
+    if limit < 1:
+        return "fail, limit must be at least 1", STATUS_BAD_REQUEST
+
+    try:
+        results = search_index.search(ReadSession, query, case_id=args.get('case_id'), start=args.get('from'),
+                                      end=args.get('to'), limit=limit)
+    except OperationalError:
+        return "fail, invalid search query", STATUS_BAD_REQUEST
+    return jsonify({"Results": results})
+
+
+@app.route('/proof', methods=['GET', 'POST'])
+@auth.login_required
+def proof():
+    """
+    Return the Merkle inclusion proof of a block, so a single block can be checked without fetching the case
+
+    Takes case_id, block_number and optionally tree_size, the length of the case to prove against, from the query
+    string for GET or the json body for POST.
+
+    :return: Block hash, tree size, root and proof
+    :rtype:
+        - Success - dictionary, 200
+        - Failure - str, 404
+    """
+    # For testing: curl -X POST -H "Content-Type:application/json" -H "Authorization:Bearer secret-token-1" http://{your ip }:5000/proof -d {\"case_id\":\"1\",\"block_number\":0}
+    args = request.args if request.method == "GET" else request.json
+    try:
+        block_number = int(args.get('block_number'))
+        tree_size = int(args['tree_size']) if args.get('tree_size') is not None else None
+    except (TypeError, ValueError):
+        return "fail, block_number and tree_size must be numbers", STATUS_NOT_FOUND
+
+    inclusion_proof = get_inclusion_proof(ReadSession, args.get('case_id'), block_number, tree_size)
+    if inclusion_proof is None:
+        return "fail, cannot find block", STATUS_NOT_FOUND
+    return jsonify(inclusion_proof)
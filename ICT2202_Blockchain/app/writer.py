@@ -0,0 +1,291 @@
+"""
+writer.py
+=========
+Single thread that makes every change to the database, committing writes that arrive together in one transaction
+"""
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, sessionmaker
+
+logger = logging.getLogger(__name__)
+
+
+@event.listens_for(Session, "after_commit", insert=True)
+def mark_committed(session):
+    """
+    Record that the transaction of a writer session reached the database, before any other commit listener runs
+
+    :param session: Session committed
+    :type session: Session
+    """
+    if "committed" in session.info:
+        session.info["committed"] = True
+
+
+class DatabaseWriter:
+    """
+    Runs write jobs one after another on its own thread and session
+
+    A job is a function taking the session as its first argument. It must not commit, the writer commits every job
+    waiting in the queue together, after waiting up to the latency budget for more to arrive. If a job of a group
+    fails, the group is rolled back and its jobs are run again one transaction each, so only the failing job is lost.
+    If the transaction reaches the database and a commit listener fails afterwards, the jobs are reported as committed.
+    Jobs should not do network I/O, the results are handed back through futures so callers can do that afterwards.
+
+    The writer keeps a connection of its own, so it never waits for the connection pool while callers holding pooled
+    connections wait for it.
+    """
+
+    def __init__(self, engine, max_batch, latency_budget, result_timeout):
+        """
+        Init function of DatabaseWriter Class
+
+        :param engine: Engine of the database
+        :type engine: Engine
+        :param max_batch: Maximum number of jobs committed together
+        :type max_batch: int
+        :param latency_budget: Seconds the first job of a group waits for others before it is committed
+        :type latency_budget: float
+        :param result_timeout: Seconds call waits for a job to be committed
+        :type result_timeout: float
+        """
+        self.engine = engine
+        self.connection = None
+        # Results are used after the commit, so they must not be expired by it
+        self.session_factory = sessionmaker(expire_on_commit=False, info={"committed": False})
+        self.max_batch = max_batch
+        self.latency_budget = latency_budget
+        self.result_timeout = result_timeout
+        self.queue = queue.Queue()
+        self.closed = False
+
+        self.lock = threading.Lock()
+        self.jobs = 0
+        self.commits = 0
+        self.failed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+        self.thread = threading.Thread(target=self._run, name="writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queue fn(session, *args, **kwargs) to run on the writer thread
+
+        :param fn: Function to run
+        :type fn: callable
+        :return: Future of the result, set once the job is committed
+        :rtype: Future
+        :raises RuntimeError: If the writer has been shut down
+        """
+        if self.closed:
+            raise RuntimeError("Writer has been shut down")
+        future = Future()
+        self.queue.put((future, time.monotonic(), fn, args, kwargs))
+        return future
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Queue fn(session, *args, **kwargs) to run on the writer thread and wait for its result
+
+        :param fn: Function to run
+        :type fn: callable
+        :return: Value returned by the job, once it is committed
+        :raises concurrent.futures.TimeoutError: If the job is not committed within the result timeout, it may still be
+            committed later
+        :raises RuntimeError: If the writer has been shut down
+        """
+        return self.submit(fn, *args, **kwargs).result(timeout=self.result_timeout)
+
+    def _next_group(self):
+        """
+        Wait for a job, then collect the jobs that arrive within the latency budget
+
+        :return: Jobs to commit together and whether the writer is stopping
+        :rtype: tuple
+        """
+        job = self.queue.get()
+        if job is None:
+            return [], True
+
+        group = [job]
+        deadline = time.monotonic() + self.latency_budget
+        while len(group) < self.max_batch:
+            try:
+                job = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if job is None:
+                return group, True
+            group.append(job)
+        return group, False
+
+    def _run(self):
+        """
+        Commit groups of jobs until shut down, then fail the jobs left in the queue
+        """
+        stopping = False
+        while not stopping:
+            group, stopping = self._next_group()
+            group = [job for job in group if job[0].set_running_or_notify_cancel()]
+            if not group:
+                continue
+            try:
+                self._commit_group(group)
+            except Exception as error:
+                # One bad group must never stop the writer, its callers are told and the next group is run
+                logger.exception("Writer failed to run a group of %s jobs", len(group))
+                for job in group:
+                    if not job[0].done():
+                        self._finish(job, error=error)
+
+        while True:
+            try:
+                job = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None and job[0].set_running_or_notify_cancel():
+                job[0].set_exception(RuntimeError("Writer has been shut down"))
+        if self.connection is not None:
+            self.connection.close()
+
+    def _session(self):
+        """
+        Return a new session on the writer's connection, opening the connection again if it has been lost
+
+        :return: Session to run jobs in
+        :rtype: Session
+        """
+        if self.connection is None or self.connection.closed or self.connection.invalidated:
+            if self.connection is not None:
+                self.connection.close()
+            self.connection = self.engine.connect()
+        return self.session_factory(bind=self.connection)
+
+    def _commit_group(self, group):
+        """
+        Run a group of jobs in one transaction, falling back to one transaction per job if any of them fails
+
+        :param group: Jobs to run
+        :type group: list
+        """
+        try:
+            session = self._session()
+        except Exception as error:
+            for job in group:
+                self._finish(job, error=error)
+            return
+        try:
+            try:
+                results = [fn(session, *args, **kwargs) for (future, submitted, fn, args, kwargs) in group]
+                self._commit(session)
+            except Exception as error:
+                session.rollback()
+                if len(group) == 1:
+                    self._finish(group[0], error=error)
+                    return
+                for job in group:
+                    self._commit_one(session, job)
+                return
+
+            with self.lock:
+                self.commits += 1
+            for job, result in zip(group, results):
+                self._finish(job, result=result)
+        finally:
+            session.close()
+
+    def _commit_one(self, session, job):
+        """
+        Run a single job in its own transaction
+
+        :param session: Session to run the job in
+        :type session: Session
+        :param job: Job to run
+        :type job: tuple
+        """
+        (future, submitted, fn, args, kwargs) = job
+        try:
+            result = fn(session, *args, **kwargs)
+            self._commit(session)
+        except Exception as error:
+            session.rollback()
+            self._finish(job, error=error)
+        else:
+            with self.lock:
+                self.commits += 1
+            self._finish(job, result=result)
+
+    def _commit(self, session):
+        """
+        Commit the session, treating a failure after the transaction reached the database as committed
+
+        A commit listener failing after the commit leaves the session committed, rolling it back would fail and running
+        the jobs again would repeat them, so the failure is only logged.
+
+        :param session: Session to commit
+        :type session: Session
+        :raises Exception: If the transaction did not reach the database
+        """
+        session.info["committed"] = False
+        try:
+            session.commit()
+        except Exception:
+            if not session.info["committed"]:
+                raise
+            logger.exception("Commit listener failed after the writer committed")
+
+    def _finish(self, job, result=None, error=None):
+        """
+        Hand the result of a job to its caller and record its metrics
+
+        :param job: Job that has finished
+        :type job: tuple
+        :param result: Value returned by the job
+        :param error: Exception raised by the job
+        :type error: Exception
+        """
+        future = job[0]
+        latency = time.monotonic() - job[1]
+        with self.lock:
+            self.jobs += 1
+            if error is not None:
+                self.failed += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+    def metrics(self):
+        """
+        Return the queue depth, group size and job latency of the writer
+
+        :return: Metrics of the writer
+        :rtype: dict
+        """
+        with self.lock:
+            return {
+                "Queue_Depth": self.queue.qsize(),
+                "Jobs": self.jobs,
+                "Commits": self.commits,
+                "Failed": self.failed,
+                "Average_Group_Size": self.jobs / self.commits if self.commits > 0 else 0.0,
+                "Average_Latency": self.total_latency / self.jobs if self.jobs > 0 else 0.0,
+                "Max_Latency": self.max_latency
+            }
+
+    def shutdown(self):
+        """
+        Stop accepting jobs, commit the ones already queued and wait for the writer thread to finish
+        """
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
@@ -0,0 +1,257 @@
+"""
+benchmark.py
+============
+Measures the cost of the scheduled jobs against a temporary database
+
+Usage: python3 benchmark.py consensus [--pool-entries 10000] [--clients 100]
+       python3 benchmark.py ingest [--entries 1000] [--cases 10]
+       python3 benchmark.py contention [--seconds 10] [--readers 4]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+DB_DIR = tempfile.mkdtemp()
+os.environ["DATABASE_URI"] = "sqlite:///" + os.path.join(DB_DIR, "benchmark.db")
+
+from sqlalchemy.dialects.sqlite import insert
+
+from app import app, db, bg_scheduler
+from app.controller import check_twothird, get_vote_threshold, send_unverified_block
+from app.models import Peers, Pool, Consensus
+from app.views import tokens
+
+HEADERS = {"Authorization": "Bearer " + next(iter(tokens))}
+
+
+def add_clients(clients):
+    """
+    Replace the peers with the given number of clients
+
+    :param clients: Number of clients
+    :type clients: int
+    :return: IP Address of the clients
+    :rtype: list
+    """
+    Peers.query.delete()
+    ip_list = ["10.0.{}.{}".format(i // 250, i % 250 + 1) for i in range(clients)]
+    db.session.add_all([Peers(ip_address, 5000, "client") for ip_address in ip_list])
+    db.session.commit()
+    return ip_list
+
+
+def add_pool(pool_entries, cases):
+    """
+    Add unverified blocks that have just been sent out, spread over the given number of cases
+
+    :param pool_entries: Number of unverified blocks
+    :type pool_entries: int
+    :param cases: Number of cases
+    :type cases: int
+    """
+    now = datetime.now()
+    rows = [{"id": i + 1, "case_id": str(i % cases), "block_number": 1, "previous_block_hash": "0" * 64,
+             "meta_data": "{}", "log": "{}", "timestamp": str(now), "block_hash": "{:064x}".format(i),
+             "status": False, "count": 0, "sendout_time": now} for i in range(pool_entries)]
+    db.session.execute(insert(Pool.__table__), rows)
+    db.session.commit()
+
+
+def add_votes(ip_list, pool_entries, votes):
+    """
+    Add positive votes from the first clients to every unverified block
+
+    :param ip_list: IP Address of the clients
+    :type ip_list: list
+    :param pool_entries: Number of unverified blocks
+    :type pool_entries: int
+    :param votes: Number of votes per block
+    :type votes: int
+    """
+    now = datetime.now()
+    rows = [{"ip_address": ip_address, "pool_id": str(i + 1), "response": True, "receive_timestamp": now}
+            for i in range(pool_entries) for ip_address in ip_list[:votes]]
+    db.session.execute(insert(Consensus.__table__), rows)
+    db.session.commit()
+
+
+def time_rounds(job, rounds):
+    """
+    Run a job a number of times
+
+    :param job: Function to run
+    :type job: callable
+    :param rounds: Number of times to run
+    :type rounds: int
+    :return: Time taken by every run in milliseconds
+    :rtype: list
+    """
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        job()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def bench_consensus(args):
+    """
+    Time check_twothird rounds where every block is one vote short of the threshold
+    """
+    ip_list = add_clients(args.clients)
+    add_pool(args.pool_entries, args.cases)
+    twothird = get_vote_threshold(db.session)
+    add_votes(ip_list, args.pool_entries, twothird - 1)
+
+    timings = time_rounds(check_twothird, args.rounds)
+    print("check_twothird with {} pending pool entries, {} clients and {} votes per entry".format(
+        args.pool_entries, args.clients, twothird - 1))
+    print("  " + summary(timings))
+
+
+def upload(client, entries, cases):
+    """
+    Upload entries spread over the given number of cases through /receiveblock
+
+    :param client: Test client of the app
+    :type client: FlaskClient
+    :param entries: Number of entries
+    :type entries: int
+    :param cases: Number of cases
+    :type cases: int
+    :return: Response of the server
+    :rtype: Response
+    """
+    pool = [{"case_id": str(i % cases), "meta_data": {"File_Name": str(i), "File_Hash": "{:064x}".format(i)},
+             "log": {"Action": "Upload", "Username": ["benchmark"]}} for i in range(entries)]
+    return client.post("/receiveblock", json={"Pool": pool}, headers=HEADERS)
+
+
+def summary(timings):
+    """
+    Format the timings of a benchmark
+
+    :param timings: Times taken in milliseconds
+    :type timings: list
+    :return: Minimum, average, 95th percentile and maximum
+    :rtype: str
+    """
+    timings = sorted(timings)
+    return "min {:.1f} ms, avg {:.1f} ms, p95 {:.1f} ms, max {:.1f} ms".format(
+        timings[0], sum(timings) / len(timings), timings[int(len(timings) * 0.95)], timings[-1])
+
+
+def bench_ingest(args):
+    """
+    Time /receiveblock uploads of a batch of entries spread over existing cases
+    """
+    add_clients(0)
+    client = app.test_client()
+
+    # Block 0 of every case
+    upload(client, args.cases, args.cases)
+    timings = time_rounds(lambda: upload(client, args.entries, args.cases), args.rounds)
+    print("/receiveblock with {} entries over {} cases".format(args.entries, args.cases))
+    print("  " + summary(timings))
+
+
+def bench_contention(args):
+    """
+    Time request traffic while the pool jobs run alongside it, every job interval instead of every 10 seconds
+    """
+    add_clients(0)
+    upload(app.test_client(), args.cases, args.cases)
+
+    stop = threading.Event()
+    timings = {"jobs": [], "/receiveblock": [], "/caseinfo": [], "/sync": []}
+    failures = []
+
+    def timed(name, call):
+        start = time.perf_counter()
+        try:
+            response = call()
+            if response is not None and response.status_code >= 500:
+                failures.append(name)
+        except Exception:
+            failures.append(name)
+        timings[name].append((time.perf_counter() - start) * 1000)
+
+    def pool_jobs():
+        send_unverified_block()
+        check_twothird()
+
+    def run_jobs():
+        while not stop.is_set():
+            timed("jobs", pool_jobs)
+            stop.wait(args.job_interval)
+
+    def write_requests():
+        client = app.test_client()
+        while not stop.is_set():
+            timed("/receiveblock", lambda: upload(client, args.entries, args.cases))
+
+    def read_requests(number):
+        client = app.test_client()
+        while not stop.is_set():
+            case_id = str(number % args.cases)
+            timed("/caseinfo", lambda: client.post("/caseinfo", json={"case_id": case_id}, headers=HEADERS))
+            timed("/sync", lambda: client.get("/sync", headers=HEADERS))
+
+    threads = [threading.Thread(target=run_jobs), threading.Thread(target=write_requests)]
+    threads += [threading.Thread(target=read_requests, args=(number,)) for number in range(args.readers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    print("{} seconds of traffic with {} readers, one writer of {} entries and the pool jobs".format(
+        args.seconds, args.readers, args.entries))
+    for name, timing in timings.items():
+        if timing:
+            print("  {:<14} {:>6} calls, {}".format(name, len(timing), summary(timing)))
+    print("  {} failed".format(len(failures)))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[-1])
+    subparsers = arg_parser.add_subparsers(dest="benchmark", required=True)
+
+    consensus_parser = subparsers.add_parser("consensus", help="Cost of one check_twothird round")
+    consensus_parser.add_argument("--pool-entries", type=int, default=10000)
+    consensus_parser.add_argument("--clients", type=int, default=100)
+    consensus_parser.add_argument("--cases", type=int, default=100)
+    consensus_parser.add_argument("--rounds", type=int, default=10)
+    consensus_parser.set_defaults(func=bench_consensus)
+
+    ingest_parser = subparsers.add_parser("ingest", help="Cost of one /receiveblock upload")
+    ingest_parser.add_argument("--entries", type=int, default=1000)
+    ingest_parser.add_argument("--cases", type=int, default=10)
+    ingest_parser.add_argument("--rounds", type=int, default=10)
+    ingest_parser.set_defaults(func=bench_ingest)
+
+    contention_parser = subparsers.add_parser("contention", help="Request latency while the pool jobs run")
+    contention_parser.add_argument("--seconds", type=int, default=10)
+    contention_parser.add_argument("--readers", type=int, default=4)
+    contention_parser.add_argument("--entries", type=int, default=100)
+    contention_parser.add_argument("--cases", type=int, default=10)
+    contention_parser.add_argument("--job-interval", type=float, default=0.5)
+    contention_parser.set_defaults(func=bench_contention)
+
+    args = arg_parser.parse_args()
+    # Keep the scheduled jobs from running during the benchmark
+    bg_scheduler.pause()
+    try:
+        args.func(args)
+    finally:
+        db.session.remove()
+        shutil.rmtree(DB_DIR, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,9 @@
+from werkzeug.serving import WSGIRequestHandler
+
 from app import app
 
 if __name__ == "__main__":
+    # Keep connections from peers alive between requests
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
     # Prevent Running Twice by Disabling Auto Reload (At least until DEBUG=False)
     app.run(host="0.0.0.0", use_reloader=False)
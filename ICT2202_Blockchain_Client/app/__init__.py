@@ -8,8 +8,14 @@ from flask_sqlalchemy import SQLAlchemy, event
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers import interval
 
+from app.executor import BoundedExecutor
+from app.liveness import PeerRegistry
+from app.wire import WireFormats, WireRequest
+
 
 app = Flask(__name__)
+# Request bodies from peers may be compressed or MessagePack
+app.request_class = WireRequest
 
 # Configurations
 if getattr(sys, 'frozen', False):
@@ -19,14 +25,32 @@ elif __file__:
 app.config["SQLALCHEMY_DATABASE_URI"] = 'sqlite:///' + os.path.join(BASE_DIR, 'app.db')
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.config["THREADS_PER_PAGE"] = 2
+app.config["CONNECT_TIMEOUT"] = 3  # Seconds to wait for a peer to accept the connection
+app.config["READ_TIMEOUT"] = 3  # Seconds to wait for a peer to respond
+app.config["HTTP_POOL_PEERS"] = 32  # Number of peers to keep connections open to
+app.config["HTTP_POOL_CONNECTIONS_PER_PEER"] = 5  # Maximum open connections to a single peer
+app.config["WIRE_FORMATS"] = ["msgpack", "zstd", "gzip"]  # Formats offered to peers, if installed, JSON is always known
+app.config["WIRE_COMPRESS_MIN_SIZE"] = 1024  # Bytes from which data sent to peers is compressed
+app.config["EXECUTOR_WORKERS"] = 5  # Worker threads for outbound requests
+app.config["EXECUTOR_QUEUE_SIZE"] = 100  # Outbound requests that can wait for a worker
+app.config["EXECUTOR_SUBMIT_TIMEOUT"] = 10  # Seconds to wait for room in a full queue
+app.config["PEER_STALE_AFTER"] = 30  # Seconds a peer is trusted to be alive after it was last heard from
+app.config["PEER_FAILURE_THRESHOLD"] = 2  # Consecutive failures before a peer is considered dead
+app.config["PEER_BACKOFF"] = 10  # Seconds before a dead peer is probed again, doubled on every failure
+app.config["PEER_MAX_BACKOFF"] = 300  # Maximum seconds before a dead peer is probed again
 # app.config.from_object('config')
 
 auth = HTTPTokenAuth(scheme='Bearer')
+executor = BoundedExecutor(app.config["EXECUTOR_WORKERS"], app.config["EXECUTOR_QUEUE_SIZE"],
+                           app.config["EXECUTOR_SUBMIT_TIMEOUT"])
+peer_registry = PeerRegistry(app.config["PEER_STALE_AFTER"], app.config["PEER_FAILURE_THRESHOLD"],
+                             app.config["PEER_BACKOFF"], app.config["PEER_MAX_BACKOFF"])
+wire_formats = WireFormats(app.config["WIRE_FORMATS"], app.config["WIRE_COMPRESS_MIN_SIZE"])
 
 db = SQLAlchemy(app)
 
 from app import views
-from app.controller import sync_schedule
+from app.controller import sync_schedule, http_session
 
 bg_scheduler = BackgroundScheduler()
 trigger = interval.IntervalTrigger(seconds=10)
@@ -61,5 +85,12 @@ def insert_initial_values(*args, **kwargs):
 # Build the database
 db.create_all()
 
-# Shut down the scheduler when exiting the app
-atexit.register(lambda: bg_scheduler.shutdown())
+
+# Shut down the scheduler, outbound workers and connections to peers when exiting the app
+def shutdown():
+    bg_scheduler.shutdown()
+    executor.shutdown()
+    http_session.close()
+
+
+atexit.register(shutdown)
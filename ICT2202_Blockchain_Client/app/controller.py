@@ -3,14 +3,36 @@ controller.py
 =============
 Functions to be called
 """
-import json.decoder
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import as_completed
 
 import requests
 from dateutil import parser
 import hashlib
-from app import db
+from requests.adapters import HTTPAdapter
+from werkzeug.http import quote_etag
+
+from app import app, db, executor, peer_registry, wire_formats
+from app.digest import BUCKETS, StateDigest, differing_buckets
+from app.executor import ExecutorFull
+from app.liveness import ALIVE, UNKNOWN
 from app.models import Pool, Peers, UserStoredInfo
+from app.wire import decode_response
+
+# Shared session so connections to peers are kept alive and reused, bounded per peer
+http_session = requests.Session()
+http_session.mount("http://", HTTPAdapter(pool_connections=app.config["HTTP_POOL_PEERS"],
+                                          pool_maxsize=app.config["HTTP_POOL_CONNECTIONS_PER_PEER"],
+                                          pool_block=True))
+
+
+def get_timeout():
+    """
+    Return the timeout used for requests to other peers
+
+    :return: Connect and read timeout in seconds
+    :rtype: tuple
+    """
+    return app.config["CONNECT_TIMEOUT"], app.config["READ_TIMEOUT"]
 
 
 def check_health(peer):
@@ -26,13 +48,19 @@ def check_health(peer):
     :rtype: Peers
     """
     try:
-        resp = requests.get("http://{}:{}/health".format(peer.ip_address, peer.port), timeout=3)
-        if resp.status_code == 200:
-            return peer
-
-        return None
+        resp = http_session.get("http://{}:{}/health".format(peer.ip_address, peer.port),
+                                headers=wire_formats.header(), timeout=get_timeout())
     except:
+        peer_registry.record_failure(peer.ip_address)
         return None
+    wire_formats.learn(peer.ip_address, resp.headers)
+
+    if resp.status_code == 200:
+        peer_registry.record_success(peer.ip_address)
+        return peer
+
+    peer_registry.record_failure(peer.ip_address)
+    return None
 
 
 def get_live_peers():
@@ -49,14 +77,20 @@ def get_live_peers():
     live_peers = []
     futures = []
 
-    pool = ThreadPoolExecutor(5)  # 5 Worker Threads
-
     # Get all peer's ip address and port from DB
     peer_list = Peers.query.filter_by(server_type="server").all()
 
-    # Use check_health() to get whether machine online
+    # Use check_health() only on machines that have not been heard from recently
     for peer in peer_list:
-        futures.append(pool.submit(check_health, peer))
+        status = peer_registry.status(peer.ip_address)
+        if status == ALIVE:
+            live_peers.append(peer)
+        elif status == UNKNOWN:
+            try:
+                futures.append(executor.submit(check_health, peer))
+            except ExecutorFull:
+                # Checked again on the next run
+                app.logger.warning("Outbound queue is full, not checking the health of %s", peer.ip_address)
 
     for x in as_completed(futures):
         result = x.result()
@@ -66,7 +100,7 @@ def get_live_peers():
     return live_peers
 
 
-def send_block(peer, data, url):
+def send_block(peer, data, url, extra_headers=None):
     """
     A function to send data to target
 
@@ -76,22 +110,38 @@ def send_block(peer, data, url):
     :type data: dict
     :param url: The target link to be sent to
     :type url: str
+    :param extra_headers: Extra headers of the request
+    :type extra_headers: dict
     :return: The response of the request sent
     :rtype:
         - "get" - Response
         - "post" - dict
     """
     url = "http://{}:{}/{}".format(peer.ip_address, peer.port, url)
-    headers = {'Content-type': 'application/json', 'Accept': 'text/plain', "Authorization": "Bearer secret-token-1"}
+    headers = {'Accept': 'text/plain', "Authorization": "Bearer secret-token-1"}
+    headers.update(wire_formats.header())
+    headers.update(extra_headers or {})
+    try:
+        if data == "":
+            r = http_session.get(url, headers=headers, timeout=get_timeout())
+        else:
+            # Sent as JSON until the peer has said it understands more
+            (body, body_headers) = wire_formats.encode(data, wire_formats.shared(peer.ip_address))
+            headers.update(body_headers)
+            r = http_session.post(url, data=body, headers=headers, timeout=get_timeout())
+    except requests.RequestException:
+        peer_registry.record_failure(peer.ip_address)
+        raise
+    peer_registry.record_success(peer.ip_address)
+    wire_formats.learn(peer.ip_address, r.headers)
+
     if data == "":
-        r = requests.get(url, headers=headers, timeout=3)
         return r
     else:
-        r = requests.post(url, json=data, headers=headers, timeout=3)
         try:
-            answer = r.json()
+            answer = decode_response(r)
 
-        except json.decoder.JSONDecodeError:
+        except ValueError:
             answer = r.text
 
         output = {
@@ -143,29 +193,64 @@ def sync_schedule():
     """
     Syncing scheduled to run frequently to ensure the database is updated with nodes
     """
-    thread_pool = ThreadPoolExecutor(5)  # 5 Worker Threads
-
     live_peers = get_live_peers()
+    local_digest = get_state_digest().snapshot()
     for peer in live_peers:
-        thread_pool.submit(send_sync, peer)
+        try:
+            executor.submit(send_sync, peer, local_digest)
+        except ExecutorFull:
+            # Synced on the next run
+            app.logger.warning("Outbound queue is full, not syncing with %s", peer.ip_address)
 
 
-def send_sync(peer):
+def get_state_digest():
+    """
+    Return the digest of the last verified block of every case, as the nodes compute it over their case heads
+
+    :return: Digest of the stored cases
+    :rtype: StateDigest
+    """
+    state_digest = StateDigest()
+    state_digest.load(UserStoredInfo.query.with_entities(UserStoredInfo.case_id, UserStoredInfo.length,
+                                                         UserStoredInfo.last_verified_hash))
+    return state_digest
+
+
+def send_sync(peer, local_digest):
     """
     Sending query to nodes to determine if current database is outdated. If outdated request from them.
 
+    The digest of the stored cases is sent first, a node with the same cases answers 304 Not Modified without a body.
+    Otherwise only the cases in the buckets whose digest differ are asked for. Nodes without /digest send every case.
+
     :param peer: Target machine ip and port
     :type peer: Peers
+    :param local_digest: Digest and bucket digests of the stored cases, from StateDigest.snapshot
+    :type local_digest: tuple
     """
-    thread_pool = ThreadPoolExecutor(5)  # 5 Worker Threads
+    (digest, bucket_digests) = local_digest
+    resp = send_block(peer, "", "digest", {"If-None-Match": quote_etag(digest)})
+    if resp.status_code == 304:
+        return None
+
+    url = "sync"
+    if resp.status_code == 200:
+        resp_json = decode_response(resp)
+        if "Buckets" not in resp_json:
+            return None
+        bucket_list = differing_buckets(bucket_digests, resp_json["Buckets"])
+        if not bucket_list:
+            return None
+        if len(bucket_list) < BUCKETS:
+            url = "sync?buckets=" + ",".join(str(bucket) for bucket in bucket_list)
 
     # Ask for his length
-    resp = send_block(peer, "", "sync")
+    resp = send_block(peer, "", url)
     if resp.status_code != 200:
         return None
 
     # Read Response
-    resp_json = resp.json()
+    resp_json = decode_response(resp)
     # Make sure json is valid
     if "Blocks" not in resp_json:
         return None
@@ -185,7 +270,11 @@ def send_sync(peer):
                 continue
 
         # If shorter, ask for update
-        thread_pool.submit(request_for_update, peer, case_id, original_block)
+        try:
+            executor.submit(request_for_update, peer, case_id, original_block)
+        except ExecutorFull:
+            # Asked for again on the next sync
+            app.logger.warning("Outbound queue is full, not updating case %s from %s", case_id, peer.ip_address)
 
 
 def request_for_update(peer, case_id, original_block):
@@ -263,6 +352,8 @@ def verify(unverified_block):
     timestamp = unverified_block.get('timestamp')
     block_hash = unverified_block.get('block_hash')
     user_block_info = UserStoredInfo.query.filter_by(case_id=caseid).first()
+    if user_block_info is None:
+        return 0
     if user_block_info.last_verified_hash == prev_hash:
         verifying = caseid + "-" + str(block_num) + "-" + metadata + "-" + log + "-" + str(timestamp) \
                           + "-" + user_block_info.last_verified_hash
@@ -273,3 +364,30 @@ def verify(unverified_block):
             return 0
     else:
         return 0
+
+
+def verify_segment(segment):
+    """
+    Verify a segment of consecutive unverified blocks of a case in one pass, starting from the last verified block
+
+    :param segment: The unverified blocks sent by the server with the same segment_id
+    :type segment: list
+    :return: return a true/false value whether every block of the segment is verified
+    :rtype: boolean
+    """
+    segment = sorted(segment, key=lambda unverified_block: unverified_block.get('block_number'))
+    caseid = segment[0].get('case_id')
+    user_block_info = UserStoredInfo.query.filter_by(case_id=caseid).first()
+    if user_block_info is None:
+        return 0
+
+    last_hash = user_block_info.last_verified_hash
+    for unverified_block in segment:
+        if unverified_block.get('case_id') != caseid or unverified_block.get('previous_block_hash') != last_hash:
+            return 0
+        verifying = caseid + "-" + str(unverified_block.get('block_number')) + "-" + unverified_block.get('meta_data') + \
+                    "-" + unverified_block.get('log') + "-" + str(unverified_block.get('timestamp')) + "-" + last_hash
+        if hashlib.sha256(verifying.encode()).hexdigest() != unverified_block.get('block_hash'):
+            return 0
+        last_hash = unverified_block.get('block_hash')
+    return 1
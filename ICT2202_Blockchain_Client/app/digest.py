@@ -0,0 +1,155 @@
+"""
+digest.py
+=========
+Digest of the heads of every case, so two machines can tell whether they hold the same blocks by comparing one hash
+"""
+import hashlib
+import threading
+
+# Number of buckets the cases are spread over, must be the same on every node and client
+BUCKETS = 256
+
+
+def bucket_of(case_id):
+    """
+    Return the bucket a case belongs to, which never changes as the case grows
+
+    :param case_id: Case ID of the case
+    :type case_id: str
+    :return: Bucket of the case
+    :rtype: int
+    """
+    return hashlib.sha256(case_id.encode()).digest()[0] % BUCKETS
+
+
+def head_hash(case_id, length, last_hash):
+    """
+    Return the hash of the head of a case
+
+    :param case_id: Case ID of the case
+    :type case_id: str
+    :param length: Number of blocks of the case
+    :type length: int
+    :param last_hash: Block hash of the last block of the case
+    :type last_hash: str
+    :return: Hash of the head
+    :rtype: int
+    """
+    data = "{}\x00{}\x00{}".format(case_id, length, last_hash).encode()
+    return int.from_bytes(hashlib.sha256(data).digest(), "big")
+
+
+def to_hex(value):
+    """
+    Return a digest as hex
+
+    :param value: Digest
+    :type value: int
+    :return: Digest, 64 hex characters
+    :rtype: str
+    """
+    return "{:064x}".format(value)
+
+
+def differing_buckets(local, remote):
+    """
+    Return the buckets whose digests differ
+
+    :param local: Bucket digests of this machine, hex
+    :type local: list
+    :param remote: Bucket digests of the peer, hex
+    :type remote: list
+    :return: Buckets that differ, all of them if the peer sent a different number of buckets
+    :rtype: list
+    """
+    if len(remote) != len(local):
+        return list(range(len(local)))
+    return [bucket for bucket in range(len(local)) if local[bucket] != remote[bucket]]
+
+
+class StateDigest:
+    """
+    Keeps the XOR of the head hashes of the cases in every bucket, and the XOR of all of them as the digest
+
+    Moving the head of a case only changes the digest of its bucket and the overall digest, so they are updated in
+    constant time. Machines holding the same case heads have the same digest, and when the digests differ the bucket
+    digests tell which cases to compare.
+    """
+
+    def __init__(self):
+        """
+        Init function of StateDigest Class
+        """
+        self.lock = threading.Lock()
+        # Case ID to the hash of its head
+        self.heads = {}
+        # Case ID of the cases in every bucket
+        self.members = [set() for _ in range(BUCKETS)]
+        self.buckets = [0] * BUCKETS
+        self.value = 0
+
+    def _set(self, case_id, new_hash):
+        """
+        Replace the head hash of a case, the lock must be held
+
+        :param case_id: Case ID of the case
+        :type case_id: str
+        :param new_hash: Hash of the new head
+        :type new_hash: int
+        """
+        bucket = bucket_of(case_id)
+        change = self.heads.get(case_id, 0) ^ new_hash
+        self.heads[case_id] = new_hash
+        self.members[bucket].add(case_id)
+        self.buckets[bucket] ^= change
+        self.value ^= change
+
+    def update(self, case_id, length, last_hash):
+        """
+        Record the new head of a case
+
+        :param case_id: Case ID of the case
+        :type case_id: str
+        :param length: Number of blocks of the case
+        :type length: int
+        :param last_hash: Block hash of the last block of the case
+        :type last_hash: str
+        """
+        new_hash = head_hash(case_id, length, last_hash)
+        with self.lock:
+            self._set(case_id, new_hash)
+
+    def load(self, heads):
+        """
+        Record the heads of many cases at once, keeping those already recorded since they are at least as new
+
+        :param heads: Case ID, length and last block hash of the cases
+        :type heads: iterable
+        """
+        hashes = [(case_id, head_hash(case_id, length, last_hash)) for (case_id, length, last_hash) in heads]
+        with self.lock:
+            for (case_id, new_hash) in hashes:
+                if case_id not in self.heads:
+                    self._set(case_id, new_hash)
+
+    def snapshot(self):
+        """
+        Return the digest of every case head and of every bucket, taken together
+
+        :return: Digest and digests by bucket, hex
+        :rtype: tuple
+        """
+        with self.lock:
+            return to_hex(self.value), [to_hex(value) for value in self.buckets]
+
+    def cases_in(self, bucket_list):
+        """
+        Return the cases in some buckets
+
+        :param bucket_list: Buckets
+        :type bucket_list: iterable
+        :return: Case ID of the cases
+        :rtype: list
+        """
+        with self.lock:
+            return [case_id for bucket in sorted(set(bucket_list)) for case_id in self.members[bucket]]
@@ -0,0 +1,120 @@
+"""
+liveness.py
+===========
+In-memory record of which peers are reachable, learnt from normal traffic
+"""
+import threading
+import time
+
+ALIVE = "alive"
+DEAD = "dead"
+UNKNOWN = "unknown"
+
+
+class PeerRegistry:
+    """
+    Keeps the last known status of every peer with a circuit breaker per peer
+
+    A peer is alive while its last success is fresh. After enough consecutive failures the circuit opens and the
+    peer is treated as dead for a backoff period that doubles on every further failure. Once the backoff is over,
+    or the last success has gone stale, the peer is unknown and may be probed again.
+    """
+
+    def __init__(self, stale_after, failure_threshold, backoff, max_backoff):
+        """
+        Init function of PeerRegistry Class
+
+        :param stale_after: Seconds a success is trusted for
+        :type stale_after: float
+        :param failure_threshold: Consecutive failures before the circuit opens
+        :type failure_threshold: int
+        :param backoff: Seconds the circuit stays open after the first failure above the threshold
+        :type backoff: float
+        :param max_backoff: Maximum seconds the circuit stays open
+        :type max_backoff: float
+        """
+        self.stale_after = stale_after
+        self.failure_threshold = failure_threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.peers = {}
+
+    def _get(self, ip_address):
+        """
+        Return the state of a peer, creating it if it has not been seen
+
+        :param ip_address: IP Address of the peer
+        :type ip_address: str
+        :return: State of the peer
+        :rtype: dict
+        """
+        if ip_address not in self.peers:
+            self.peers[ip_address] = {"last_success": None, "failures": 0, "open_until": 0.0}
+        return self.peers[ip_address]
+
+    def record_success(self, ip_address):
+        """
+        Record that the peer answered a request or sent one to us
+
+        :param ip_address: IP Address of the peer
+        :type ip_address: str
+        """
+        with self.lock:
+            state = self._get(ip_address)
+            state["last_success"] = time.monotonic()
+            state["failures"] = 0
+            state["open_until"] = 0.0
+
+    def record_failure(self, ip_address):
+        """
+        Record that a request to the peer failed, opening the circuit once the threshold is reached
+
+        :param ip_address: IP Address of the peer
+        :type ip_address: str
+        """
+        with self.lock:
+            state = self._get(ip_address)
+            state["failures"] += 1
+            if state["failures"] >= self.failure_threshold:
+                backoff = self.backoff * 2 ** (state["failures"] - self.failure_threshold)
+                state["open_until"] = time.monotonic() + min(backoff, self.max_backoff)
+
+    def status(self, ip_address):
+        """
+        Return whether the peer is alive, dead or needs to be probed
+
+        :param ip_address: IP Address of the peer
+        :type ip_address: str
+        :return: ALIVE, DEAD or UNKNOWN
+        :rtype: str
+        """
+        now = time.monotonic()
+        with self.lock:
+            state = self._get(ip_address)
+            if state["open_until"] > now:
+                return DEAD
+            if state["failures"] == 0 and state["last_success"] is not None \
+                    and now - state["last_success"] < self.stale_after:
+                return ALIVE
+            return UNKNOWN
+
+    def is_available(self, ip_address):
+        """
+        Return whether requests may be sent to the peer, False while its circuit is open
+
+        :param ip_address: IP Address of the peer
+        :type ip_address: str
+        :rtype: bool
+        """
+        return self.status(ip_address) != DEAD
+
+    def metrics(self):
+        """
+        Return the status and consecutive failures of every known peer
+
+        :return: Status of the peers
+        :rtype: dict
+        """
+        return {ip_address: {"Status": self.status(ip_address), "Failures": self.peers[ip_address]["failures"]}
+                for ip_address in list(self.peers)}
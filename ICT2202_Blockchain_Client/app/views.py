@@ -4,12 +4,12 @@ views.py
 The webpage routing of flask server
 """
 import sys
-from concurrent.futures import ThreadPoolExecutor
 
 from flask import request
 
-from app import app, db, auth
-from app.controller import send_block, verify
+from app import app, db, auth, executor, peer_registry, wire_formats
+from app.controller import send_block, verify, verify_segment
+from app.executor import ExecutorFull
 from app.models import UserStoredInfo, Peers
 
 STATUS_OK = 200
@@ -22,6 +22,26 @@ tokens = {
 }
 
 
+def record_inbound():
+    """
+    Any authenticated request received from a peer in the peer list shows that it is alive, other addresses are not
+    recorded so they cannot fill the registry or pass for a peer
+    """
+    if Peers.query.with_entities(Peers.id).filter_by(ip_address=request.remote_addr).first() is None:
+        return
+    peer_registry.record_success(request.remote_addr)
+    wire_formats.learn(request.remote_addr, request.headers)
+
+
+@app.after_request
+def advertise_formats(response):
+    """
+    Tell the requester which formats it can send data to this machine in
+    """
+    response.headers.update(wire_formats.header())
+    return response
+
+
 @app.route("/health")
 def current_health():
     """
@@ -38,11 +58,25 @@ def current_health():
     return resp, STATUS_OK
 
 
+@app.route("/metrics")
+@auth.login_required
+def metrics():
+    """
+    Return metrics of the outbound worker pool and known peers
+
+    :return: Queue depth and task latency of the outbound workers, status of the peers
+    :rtype:
+        - dict
+        - Status 200
+    """
+    return {"Executor": executor.metrics(), "Peers": peer_registry.metrics()}, STATUS_OK
+
+
 @app.route("/sync", methods=["POST"])
 @auth.login_required
 def get_latest_verified():
     """
-    Receives latest block through sync
+    Receives latest blocks through sync
 
     :return: Whether sync succeeded
     :rtype:
@@ -50,9 +84,32 @@ def get_latest_verified():
         - Failure - Status 404
     """
     # {"case_id": "1", "previous_hash": "123", "last_verified_hash":"123", "length":"2"}
+    # or {"Blocks": [{"case_id": "1", ...}, ...]} for several blocks, in order within each case
     sync_json = request.get_json()
-    if "case_id" not in sync_json or "previous_hash" not in sync_json or "last_verified_hash" not in sync_json or "length" not in sync_json:
+    if "Blocks" in sync_json:
+        update_list = sync_json["Blocks"]
+    else:
+        update_list = [sync_json]
+
+    # Blocks that follow are kept even if others do not
+    applied = [apply_latest_verified(update) for update in update_list]
+    db.session.commit()
+    if not all(applied):
         return "", STATUS_NOT_FOUND
+    return "", STATUS_OK
+
+
+def apply_latest_verified(sync_json):
+    """
+    Move the stored last verified block of a case forward by one block
+
+    :param sync_json: The new verified block
+    :type sync_json: dict
+    :return: Whether the block follows the stored last verified block
+    :rtype: bool
+    """
+    if "case_id" not in sync_json or "previous_hash" not in sync_json or "last_verified_hash" not in sync_json or "length" not in sync_json:
+        return False
 
     json_case_id = sync_json["case_id"]
     json_previous_hash = sync_json["previous_hash"]
@@ -65,40 +122,51 @@ def get_latest_verified():
         new_stored_info = UserStoredInfo(json_case_id, json_last_verified_hash, json_length)
         db.session.add(new_stored_info)
     # If new matches to current last hash
-    elif last_hash_block.last_verified_hash == json_previous_hash and last_hash_block.length == json_length - 1:
+    elif last_hash_block is not None and last_hash_block.last_verified_hash == json_previous_hash \
+            and last_hash_block.length == json_length - 1:
         last_hash_block.last_verified_hash = json_last_verified_hash
         last_hash_block.length += 1
     else:
-        return "", STATUS_NOT_FOUND
-
-    db.session.commit()
-    return "", STATUS_OK
+        return False
+    return True
 
 
 @app.route('/receivepool', methods=['POST'])
 @auth.login_required
 def receive():
     """
-    Receive block sent by the server 
+    Receive blocks sent by the server and vote on every one of them
 
     :return: return the address of the server
     :rtype: ip address
     """
-    thread_pool = ThreadPoolExecutor(5)  # 5 Worker Threads
-
     # Process JSON to Pool Model Object
     pool_json = request.get_json()  # Convert string to json object
+    votes = []
+    segments = {}
     for pool in pool_json["Pool"]:
         if pool is None:
             return {"Format": "Wrong"}
-        else:
+        elif pool.get('segment_id') is None:
             verified = verify(pool)
-            resp = {"pool_id": pool.get('id'), "response": verified}  # Placeholder
-            # Send Response Back to Server
-            peer = Peers(request.remote_addr, 5000, None)
-            thread_pool.submit(send_block, peer, resp, "receive_response")  # send block to user
+            votes.append({"pool_id": pool.get('id'), "response": verified})
+        else:
+            segments.setdefault(pool.get('segment_id'), []).append(pool)
+
+    # A segment is voted on as a whole, through the id of its first block
+    for segment_id, segment in segments.items():
+        votes.append({"pool_id": segment_id, "response": verify_segment(segment)})
+
+    # Send all votes back to server in one response
+    peer = Peers(request.remote_addr, 5000, None)
+    try:
+        # Never holds up the response to the server
+        executor.try_submit(send_block, peer, {"Votes": votes}, "receive_response")
+    except ExecutorFull:
+        # The server sends the blocks out again once they time out
+        app.logger.warning("Outbound queue is full, not sending votes to %s", peer.ip_address)
 
-        return request.remote_addr, STATUS_OK
+    return request.remote_addr, STATUS_OK
 
 
 @auth.verify_token
@@ -113,5 +181,6 @@ def verify_token(token):
         - Success - str, username
     """
     if token in tokens:
+        record_inbound()
         return tokens[token]
 
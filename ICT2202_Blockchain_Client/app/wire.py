@@ -0,0 +1,270 @@
+"""
+wire.py
+=======
+Encoding of the data sent between nodes and clients, MessagePack and zstd or gzip when both sides support them, JSON
+otherwise
+"""
+import gzip
+import json
+import threading
+import zlib
+
+from flask import Request, current_app, request
+from urllib3.util.request import ACCEPT_ENCODING
+from werkzeug.exceptions import BadRequest
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+# Lists the formats a machine understands, sent with every request and response between nodes and clients
+FORMATS_HEADER = "X-Wire-Formats"
+# Whether requests decodes zstd responses itself, it always decodes gzip
+ZSTD_DECODED_BY_REQUESTS = "zstd" in ACCEPT_ENCODING
+# Errors raised by gzip and zstd for data that is not valid, zstandard.ZstdError derives from no standard exception
+DECOMPRESS_ERRORS = (OSError, EOFError, zlib.error) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+def available_formats():
+    """
+    Return the formats this machine can encode and decode, best first
+
+    :return: Names of the formats
+    :rtype: list
+    """
+    formats = []
+    if msgpack is not None:
+        formats.append("msgpack")
+    if zstandard is not None:
+        formats.append("zstd")
+    formats.append("gzip")
+    return formats
+
+
+def compress(data, encoding):
+    """
+    Compress data with a content encoding
+
+    :param data: Data to compress
+    :type data: bytes
+    :param encoding: "zstd" or "gzip"
+    :type encoding: str
+    :return: Compressed data
+    :rtype: bytes
+    """
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor().compress(data)
+    return gzip.compress(data, compresslevel=5)
+
+
+def decompress(data, encoding):
+    """
+    Decompress data with the content encoding it was sent with
+
+    :param data: Data received
+    :type data: bytes
+    :param encoding: Content-Encoding of the data, None if not compressed
+    :type encoding: str
+    :return: Decompressed data
+    :rtype: bytes
+    :raises ValueError: If the encoding is not supported or the data cannot be decompressed
+    """
+    if not encoding or encoding == "identity":
+        return data
+    try:
+        if encoding == "gzip":
+            return gzip.decompress(data)
+        if encoding == "zstd" and zstandard is not None:
+            return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    except DECOMPRESS_ERRORS as error:
+        raise ValueError("Cannot decompress {} data: {}".format(encoding, error)) from error
+    raise ValueError("Unsupported content encoding: {}".format(encoding))
+
+
+def loads(data, content_type):
+    """
+    Decode data with the format it was sent with
+
+    :param data: Data received, decompressed
+    :type data: bytes
+    :param content_type: Mimetype of the data
+    :type content_type: str
+    :return: Decoded data
+    :raises ValueError: If the data cannot be decoded
+    """
+    if content_type == MSGPACK:
+        if msgpack is None:
+            raise ValueError("MessagePack is not installed")
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except msgpack.UnpackException as error:
+            # Older versions of msgpack raise errors that are not ValueError
+            raise ValueError("Cannot decode MessagePack data: {}".format(error)) from error
+    return json.loads(data)
+
+
+class WireFormats:
+    """
+    Keeps the formats every peer understands, learned from the FORMATS_HEADER of what it sends
+
+    Peers that have not sent the header, such as peers running an older version, are sent plain JSON.
+    """
+
+    def __init__(self, formats, min_compress_size):
+        """
+        Init function of WireFormats Class
+
+        :param formats: Formats this machine offers, those that are not installed are left out
+        :type formats: list
+        :param min_compress_size: Bytes from which data is compressed
+        :type min_compress_size: int
+        """
+        self.local = [name for name in available_formats() if name in formats]
+        self.min_compress_size = min_compress_size
+        self.lock = threading.Lock()
+        self.peers = {}
+
+    def header(self):
+        """
+        Return the headers advertising the formats of this machine
+
+        :return: Headers
+        :rtype: dict
+        """
+        headers = {FORMATS_HEADER: ", ".join(self.local)}
+        encodings = [name for name in ("zstd", "gzip") if name in self.local]
+        if encodings:
+            headers["Accept-Encoding"] = ", ".join(encodings)
+        return headers
+
+    def learn(self, ip_address, headers):
+        """
+        Record the formats a peer advertised
+
+        :param ip_address: ip address of the peer
+        :type ip_address: str
+        :param headers: Headers of a request or response from the peer
+        :type headers: Mapping
+        """
+        value = headers.get(FORMATS_HEADER)
+        if value is None:
+            return
+        formats = {name.strip() for name in value.split(",")}
+        with self.lock:
+            self.peers[ip_address] = formats
+
+    def shared(self, ip_address):
+        """
+        Return the formats both this machine and the peer understand
+
+        :param ip_address: ip address of the peer
+        :type ip_address: str
+        :return: Names of the formats
+        :rtype: set
+        """
+        with self.lock:
+            formats = self.peers.get(ip_address, set())
+        return formats.intersection(self.local)
+
+    def encode(self, data, formats):
+        """
+        Encode data in the best of the given formats
+
+        :param data: Data to send
+        :type data: dict
+        :param formats: Formats the receiver understands
+        :type formats: set
+        :return: Encoded data and its Content-Type and Content-Encoding headers
+        :rtype: tuple
+        """
+        if "msgpack" in formats:
+            body = msgpack.packb(data, use_bin_type=True)
+            headers = {"Content-Type": MSGPACK}
+        else:
+            body = json.dumps(data).encode()
+            headers = {"Content-Type": JSON}
+
+        if len(body) >= self.min_compress_size:
+            for encoding in ("zstd", "gzip"):
+                if encoding in formats:
+                    body = compress(body, encoding)
+                    headers["Content-Encoding"] = encoding
+                    break
+        return body, headers
+
+    def respond(self, data, status=200):
+        """
+        Build the response to the current request, in the best format the requester accepts
+
+        MessagePack is only sent to requesters that list it in their FORMATS_HEADER, compression follows the
+        standard Accept-Encoding header.
+
+        :param data: Data to send
+        :type data: dict
+        :param status: Status code of the response
+        :type status: int
+        :return: Response
+        :rtype: Response
+        """
+        formats = set()
+        requester_formats = {name.strip() for name in request.headers.get(FORMATS_HEADER, "").split(",")}
+        if "msgpack" in self.local and "msgpack" in requester_formats:
+            formats.add("msgpack")
+        encoding = request.accept_encodings.best_match([name for name in ("zstd", "gzip") if name in self.local])
+        if encoding is not None:
+            formats.add(encoding)
+
+        (body, headers) = self.encode(data, formats)
+        headers["Vary"] = ", ".join([FORMATS_HEADER, "Accept-Encoding"])
+        return current_app.response_class(body, status=status, headers=headers)
+
+
+def decode_response(response):
+    """
+    Decode the body of a response from a peer
+
+    :param response: Response from the peer
+    :type response: requests.Response
+    :return: Decoded body
+    :raises ValueError: If the body cannot be decoded
+    """
+    data = response.content
+    if response.headers.get("Content-Encoding") == "zstd" and not ZSTD_DECODED_BY_REQUESTS:
+        data = decompress(data, "zstd")
+    content_type = response.headers.get("Content-Type", JSON).split(";")[0].strip()
+    return loads(data, content_type)
+
+
+class WireRequest(Request):
+    """
+    Request that decompresses its body and decodes MessagePack bodies in get_json, so views read every format the
+    same way
+    """
+
+    def get_data(self, cache=True, as_text=False, parse_form_data=False):
+        data = super().get_data(cache=cache, as_text=False, parse_form_data=parse_form_data)
+        try:
+            data = decompress(data, self.content_encoding)
+        except Exception:
+            raise BadRequest("Body cannot be decompressed")
+        if as_text:
+            return data.decode(self.charset, self.encoding_errors)
+        return data
+
+    def get_json(self, force=False, silent=False, cache=True):
+        if self.mimetype == MSGPACK:
+            try:
+                return loads(self.get_data(cache=cache), MSGPACK)
+            except ValueError as error:
+                if silent:
+                    return None
+                return self.on_json_loading_failed(error)
+        return super().get_json(force=force, silent=silent, cache=cache)
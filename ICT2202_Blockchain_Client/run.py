@@ -1,4 +1,8 @@
+from werkzeug.serving import WSGIRequestHandler
+
 from app import app
 
 if __name__ == "__main__":
+    # Keep connections from peers alive between requests
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
     app.run(host="0.0.0.0", use_reloader=False)